@@ -1,35 +1,94 @@
 import os
+import queue
 import sqlite3
-import json
-from flask import Flask, render_template, request, redirect, url_for, session, g, Response, jsonify, flash
+import orjson
+import time
+import tempfile
+from pathlib import Path
+from urllib.parse import unquote
+from flask import Flask, Request, render_template, request, redirect, url_for, session, g, Response, jsonify, flash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 
-from db import get_db, close_db, init_db, get_user, get_user_files, get_user_file
+from db import get_db, close_db, init_db, get_user, get_user_password_hash, get_user_files, get_recent_files, get_user_file, get_user_stats, get_system_stats, get_file_status, create_file_entry
 from auth_system import (
     login_required, onboarding_required, credentials_required,
     register_user, login_user, destroy_session, destroy_all_user_sessions,
     get_user_sessions, mark_onboarding_complete, update_user_telegram_credentials,
-    mark_credentials_verified
+    mark_credentials_verified, forget_user_sessions
 )
-from encryption import encrypt_bot_token, decrypt_bot_token
+from encryption import encrypt_bot_token, get_bot_token
 from rate_limiter import (
-    check_daily_upload_limit, check_file_size_limit,
+    MAX_DAILY_UPLOADS, upload_day, reserve_daily_upload, release_daily_upload, check_file_size_limit,
     check_concurrent_download_limit, register_download_start,
     register_download_end, get_user_limits_status
 )
-from uploader import start_upload
+from uploader import start_upload, start_stream_upload
+from utils.chunker import yield_stream_chunks
+from utils.packing import unpack_message_ids
 import downloader
+import background
+import progress
 from telegram_client import TelegramClient
 import dotenv
 dotenv.load_dotenv()
 
+from log_setup import setup_logging
+setup_logging()
+
+class UploadRequest(Request):
+    """
+    Request that spools multipart file parts straight into UPLOAD_FOLDER.
+    Werkzeug's default factory buffers large parts in a SpooledTemporaryFile
+    (usually /tmp, often tmpfs), which the upload route then copied again.
+    Parts written here are claimed with a rename; unclaimed ones are removed
+    when the request closes.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile(
+            'w+b', dir=UPLOAD_DIR, prefix='spool_', delete=False
+        )
+        self.__dict__.setdefault('_spooled_paths', []).append(stream.name)
+        return stream
+
+    def close(self):
+        super().close()
+        for path in self.__dict__.get('_spooled_paths', ()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Claimed by the upload route
+
 # Init App
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-CHANGE-IN-PRODUCTION')
 app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', 'temp_uploads')
 
+# Reverse proxies in front of the app, if any. Their X-Forwarded-For gives
+# request.remote_addr the real client IP, which login throttling keys on.
+# Off by default: run_production.py serves clients directly, and trusting the
+# header there would let any client pick its own address.
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+# Resolved once; uploads are claimed into a per-user subdirectory
+UPLOAD_DIR = Path(app.config['UPLOAD_FOLDER'])
+
 # Ensure upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+_user_upload_dirs = {}
+
+def user_upload_dir(user_id):
+    """Per-user temp upload directory (created on first use)"""
+    user_dir = _user_upload_dirs.get(user_id)
+    if user_dir is None:
+        user_dir = UPLOAD_DIR / str(user_id)
+        user_dir.mkdir(exist_ok=True)
+        _user_upload_dirs[user_id] = user_dir
+    return user_dir
 
 # DB Teardown
 app.teardown_appcontext(close_db)
@@ -66,6 +125,8 @@ def signup():
             flash(error, 'error')
             return render_template('signup.html')
         
+        user_upload_dir(user_id)
+        
         # Auto-login after signup
         session['session_token'] = login_user(email, password)[1]
         
@@ -154,12 +215,11 @@ def onboarding_verify():
 @onboarding_required
 def dashboard():
     """User dashboard with files and stats"""
-    files = get_user_files(g.user_id)
+    # Stats come from the aggregates table, not a scan of every file
+    stats = get_user_stats(g.user_id)
     
-    # Calculate stats
-    total_files = len(files)
-    total_size = sum(f['size'] or 0 for f in files)
-    completed_files = sum(1 for f in files if f['status'] == 'completed')
+    # Recent 20, cached until the user's files change
+    files = get_recent_files(g.user_id, stats['version'], limit=20)
     
     # Get limits status
     limits = get_user_limits_status(g.user_id)
@@ -168,10 +228,10 @@ def dashboard():
     credentials_ok = g.user.get('credentials_verified', 0) == 1
     
     return render_template('dashboard.html', 
-                         files=files[:20],  # Show recent 20
-                         total_files=total_files,
-                         total_size=total_size,
-                         completed_files=completed_files,
+                         files=files,
+                         total_files=stats['total_files'],
+                         total_size=stats['total_bytes'],
+                         completed_files=stats['completed_files'],
                          limits=limits,
                          credentials_ok=credentials_ok)
 
@@ -200,25 +260,11 @@ def upload():
 
     # Get user's decrypted bot token once
     encrypted_token = g.user.get('bot_token_encrypted')
-    bot_token = decrypt_bot_token(encrypted_token)
+    bot_token = get_bot_token(g.user_id, encrypted_token)
     channel_id = g.user.get('channel_id')
+    user_dir = user_upload_dir(g.user_id)
 
     for file in files:
-        # Check rate limits per file
-        can_upload, current_count, resets_in = check_daily_upload_limit(g.user_id)
-        if not can_upload:
-            # If we've already started some uploads, return partial success
-            if created_file_ids:
-                return jsonify({
-                    'error': 'Daily upload limit reached',
-                    'message': f'You have uploaded {current_count}/20 files today. Limit resets in {resets_in} hours.',
-                    'file_ids': created_file_ids
-                }), 429
-            return jsonify({
-                'error': 'Daily upload limit reached',
-                'message': f'You have uploaded {current_count}/20 files today. Limit resets in {resets_in} hours.'
-            }), 429
-
         # Check file size
         file.seek(0, os.SEEK_END)
         file_size = file.tell()
@@ -231,22 +277,32 @@ def upload():
                 'message': f'File is {size_mb:.1f} MB. Free plan allows max 100 MB per file.'
             }), 400
 
+        # Consume one of today's uploads (atomic, per file)
+        can_upload, resets_in = reserve_daily_upload(g.user_id)
+        if not can_upload:
+            # If we've already started some uploads, return partial success
+            if created_file_ids:
+                return jsonify({
+                    'error': 'Daily upload limit reached',
+                    'message': f'You have uploaded {MAX_DAILY_UPLOADS}/{MAX_DAILY_UPLOADS} files today. Limit resets in {resets_in} hours.',
+                    'file_ids': created_file_ids
+                }), 429
+            return jsonify({
+                'error': 'Daily upload limit reached',
+                'message': f'You have uploaded {MAX_DAILY_UPLOADS}/{MAX_DAILY_UPLOADS} files today. Limit resets in {resets_in} hours.'
+            }), 429
+
         filename = secure_filename(file.filename)
         if not filename:
             filename = "unnamed_file"
 
-        # Save to temp
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{g.user_id}_{filename}")
-        file.save(temp_path)
+        # Claim the spooled part (already on disk in UPLOAD_FOLDER)
+        temp_path = user_dir / filename
+        file.stream.close()
+        os.replace(file.stream.name, temp_path)
 
         # Create DB Entry with user_id
-        db = get_db()
-        cursor = db.execute('''
-            INSERT INTO files (user_id, filename, size, chunks, status, message_ids, chunk_hashes) 
-            VALUES (?, ?, ?, 0, 'uploading', '[]', '[]')
-        ''', (g.user_id, filename, file_size))
-        db.commit()
-        file_id = cursor.lastrowid
+        file_id = create_file_entry(g.user_id, filename, file_size)
         created_file_ids.append(file_id)
 
         # Start Background Upload (threaded)
@@ -254,6 +310,7 @@ def upload():
             start_upload(g.user_id, file_id, temp_path, filename, bot_token, channel_id)
         except Exception as e:
             # If upload start fails, mark credentials as broken
+            release_daily_upload(g.user_id, upload_day())
             mark_credentials_verified(g.user_id, verified=False)
             return jsonify({
                 'error': 'Telegram connection failed',
@@ -266,19 +323,84 @@ def upload():
 
     return jsonify({'success': True, 'file_ids': created_file_ids})
 
+@app.route('/upload/stream', methods=['PUT'])
+@login_required
+@onboarding_required
+@credentials_required
+def upload_stream():
+    """
+    Raw-body upload (one file per request, name in X-Filename).
+    Chunks are handed to the Telegram worker as they are read from the
+    request body, without landing on disk first.
+    """
+    file_size = request.content_length
+    if file_size is None:
+        return jsonify({'error': 'Content-Length required'}), 411
+
+    within_limit, size_mb = check_file_size_limit(file_size)
+    if not within_limit:
+        return jsonify({
+            'error': 'File too large',
+            'message': f'File is {size_mb:.1f} MB. Free plan allows max 100 MB per file.'
+        }), 400
+
+    can_upload, resets_in = reserve_daily_upload(g.user_id)
+    if not can_upload:
+        return jsonify({
+            'error': 'Daily upload limit reached',
+            'message': f'You have uploaded {MAX_DAILY_UPLOADS}/{MAX_DAILY_UPLOADS} files today. Limit resets in {resets_in} hours.'
+        }), 429
+
+    filename = secure_filename(unquote(request.headers.get('X-Filename', '')))
+    if not filename:
+        filename = "unnamed_file"
+
+    encrypted_token = g.user.get('bot_token_encrypted')
+    bot_token = get_bot_token(g.user_id, encrypted_token)
+    channel_id = g.user.get('channel_id')
+
+    file_id = create_file_entry(g.user_id, filename, file_size)
+
+    try:
+        pipe = start_stream_upload(g.user_id, file_id, filename, file_size, bot_token, channel_id)
+    except Exception as e:
+        # If upload start fails, mark credentials as broken
+        release_daily_upload(g.user_id, upload_day())
+        mark_credentials_verified(g.user_id, verified=False)
+        return jsonify({
+            'error': 'Telegram connection failed',
+            'message': 'Could not start upload. Your credentials may be invalid.'
+        }), 500
+
+    received = 0
+    try:
+        for chunk in yield_stream_chunks(request.stream):
+            received += len(chunk)
+            if not pipe.put(chunk):
+                return jsonify({
+                    'error': 'Upload failed',
+                    'message': 'Telegram upload stopped before the file was received.'
+                }), 502
+    except Exception as e:
+        pipe.abort(e)
+        return jsonify({'error': 'Upload interrupted'}), 400
+
+    if received != file_size:
+        pipe.abort(Exception(f"Received {received} of {file_size} bytes"))
+        return jsonify({'error': 'Upload interrupted'}), 400
+
+    pipe.finish()
+    return jsonify({'success': True, 'file_id': file_id})
+
 @app.route('/files')
 @login_required
 @onboarding_required
 def files():
     """All files screen with search/filter"""
     status_filter = request.args.get('status')
-    search_query = request.args.get('q', '').lower()
-    
-    all_files = get_user_files(g.user_id, status=status_filter)
+    search_query = request.args.get('q', '')
     
-    # Client-side search simulation
-    if search_query:
-        all_files = [f for f in all_files if search_query in f['filename'].lower()]
+    all_files = get_user_files(g.user_id, status=status_filter, search=search_query)
     
     return render_template('files.html', files=all_files)
 
@@ -305,7 +427,7 @@ def download_file(file_id):
         
         # Get user's credentials
         encrypted_token = g.user.get('bot_token_encrypted')
-        bot_token = decrypt_bot_token(encrypted_token)
+        bot_token = get_bot_token(g.user_id, encrypted_token)
         channel_id = g.user.get('channel_id')
         
         # Prepare download with user's Telegram client
@@ -340,7 +462,7 @@ def download_file(file_id):
         
     except Exception as e:
         register_download_end(g.user_id, file_id)
-        print(f"[DownloadRoute] Error: {e}")
+        app.logger.exception("Download failed for file %s", file_id)
         return f"Download Error: {str(e)}", 500
 
 @app.route('/files/<int:file_id>/delete', methods=['POST'])
@@ -355,42 +477,120 @@ def delete_file(file_id):
     if status not in ('completed', 'failed'):
         return jsonify({'error': 'Cannot delete file in progress'}), 400
 
-    # Delete from Telegram using user's credentials
+    # Delete from DB first so the file disappears immediately
+    db = get_db()
+    db.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (file_id, g.user_id))
+    db.commit()
+
+    # Delete from Telegram using user's credentials (in the background)
     try:
         encrypted_token = g.user.get('bot_token_encrypted')
-        bot_token = decrypt_bot_token(encrypted_token)
+        bot_token = get_bot_token(g.user_id, encrypted_token)
         channel_id = g.user.get('channel_id')
         
-        message_ids = json.loads(file['message_ids'])
-        client = TelegramClient(token=bot_token, channel_id=channel_id)
-        
-        for msg_id in message_ids:
-            try:
-                client.delete_message(msg_id)
-            except:
-                pass  # Ignore already missing
-    except Exception as e:
-        print(f"Error deleting messages: {e}")
-
-    # Delete from DB
-    db = get_db()
-    db.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (file_id, g.user_id))
-    db.commit()
+        message_ids = unpack_message_ids(file['message_ids'])
+        if bot_token and message_ids:
+            client = TelegramClient(token=bot_token, channel_id=channel_id)
+            background.submit(client.delete_messages, message_ids)
+    except Exception:
+        app.logger.exception("Error scheduling message deletion for file %s", file_id)
     
-    return jsonify({'success': True})
+    return jsonify({'success': True}), 202
 
 @app.route('/check_status/<int:file_id>')
 @login_required
 def check_status(file_id):
     """Check upload status (user-isolated)"""
-    file = get_user_file(g.user_id, file_id)
-    if not file:
-        return jsonify({'error': 'Not found'}), 404
-    
-    return jsonify({
-        'status': file['status'], 
-        'uploaded': file['uploaded_chunks'], 
-        'total': file['chunks']
+    # Running uploads are answered from memory; finished ones from the DB
+    current = progress.get(g.user_id, file_id)
+    if current:
+        status, uploaded, total = current
+    else:
+        file = get_file_status(g.user_id, file_id)
+        if not file:
+            return jsonify({'error': 'Not found'}), 404
+        status, uploaded, total = file['status'], file['uploaded_chunks'], file['chunks']
+    
+    # Unchanged progress (e.g. a finished upload) is answered with a bare 304
+    etag = f'{status}:{uploaded}:{total}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({
+            'status': status, 
+            'uploaded': uploaded, 
+            'total': total
+        })
+    response.set_etag(etag)
+    # Browser keeps the body and revalidates it with If-None-Match on every poll
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Idle SSE streams send a comment this often (also how a closed tab is noticed)
+SSE_KEEPALIVE_SECONDS = 15
+# Streams are closed after this long; EventSource clients reconnect on their own
+SSE_MAX_STREAM_SECONDS = 600
+# A ?file_id= stream ends once that file reaches one of these
+SSE_FINAL_STATUSES = ('completed', 'failed')
+
+def _sse(user_id, updates, snapshot=None, file_id=None):
+    """
+    Format progress updates from a subscriber queue as Server-Sent Events.
+    With file_id, the stream ends after that file's final status is sent.
+    """
+    deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+    try:
+        if snapshot:
+            yield f"data: {orjson.dumps(snapshot).decode()}\n\n"
+            if snapshot['status'] in SSE_FINAL_STATUSES:
+                return
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = updates.get(timeout=min(SSE_KEEPALIVE_SECONDS, remaining))
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {orjson.dumps(event).decode()}\n\n"
+            if event['file_id'] == file_id and event['status'] in SSE_FINAL_STATUSES:
+                return
+    finally:
+        progress.unsubscribe(user_id, updates)
+
+@app.route('/events')
+@login_required
+def events():
+    """
+    Push upload progress to the browser (replaces polling /check_status).
+    With ?file_id=, that file's current status is sent first so an upload
+    that finished before the stream opened is not missed, and the stream
+    closes once the file has completed or failed.
+    """
+    file_id = request.args.get('file_id', type=int)
+    updates = progress.subscribe(g.user_id)
+    
+    snapshot = None
+    try:
+        if file_id is not None:
+            current = progress.get(g.user_id, file_id)
+            if current:
+                status, uploaded, total = current
+            else:
+                file = get_file_status(g.user_id, file_id)
+                if not file:
+                    progress.unsubscribe(g.user_id, updates)
+                    return jsonify({'error': 'Not found'}), 404
+                status, uploaded, total = file['status'], file['uploaded_chunks'], file['chunks']
+            snapshot = {'file_id': file_id, 'status': status, 'uploaded': uploaded, 'total': total}
+    except Exception:
+        progress.unsubscribe(g.user_id, updates)
+        raise
+    
+    return Response(_sse(g.user_id, updates, snapshot, file_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Don't let a reverse proxy hold events back
     })
 
 # ==================== SETTINGS ====================
@@ -408,7 +608,7 @@ def settings_telegram():
     # Mask bot token for display
     encrypted_token = g.user.get('bot_token_encrypted')
     if encrypted_token:
-        decrypted = decrypt_bot_token(encrypted_token)
+        decrypted = get_bot_token(g.user_id, encrypted_token)
         masked_token = decrypted[:8] + '•' * 20 if decrypted else None
     else:
         masked_token = None
@@ -424,7 +624,7 @@ def settings_telegram():
 def settings_telegram_verify():
     """Re-verify existing credentials"""
     encrypted_token = g.user.get('bot_token_encrypted')
-    bot_token = decrypt_bot_token(encrypted_token)
+    bot_token = get_bot_token(g.user_id, encrypted_token)
     channel_id = g.user.get('channel_id')
     
     if not bot_token or not channel_id:
@@ -482,7 +682,7 @@ def settings_account_password():
     new_password = request.form.get('new_password')
     
     # Verify current password
-    if not verify_pw(current_password, g.user['password_hash']):
+    if not verify_pw(current_password, get_user_password_hash(g.user_id)):
         flash('Current password is incorrect', 'error')
         return redirect(url_for('settings_account'))
     
@@ -491,6 +691,7 @@ def settings_account_password():
     db = get_db()
     db.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, g.user_id))
     db.commit()
+    forget_user_sessions(g.user_id)
     
     flash('Password changed successfully', 'success')
     return redirect(url_for('settings_account'))
@@ -502,6 +703,7 @@ def revoke_session(session_id):
     db = get_db()
     db.execute('DELETE FROM sessions WHERE id = ? AND user_id = ?', (session_id, g.user_id))
     db.commit()
+    forget_user_sessions(g.user_id)
     
     return jsonify({'success': True})
 
@@ -521,29 +723,24 @@ def settings_limits():
     limits = get_user_limits_status(g.user_id)
     
     # Get usage stats
-    db = get_db()
-    total_files = db.execute('SELECT COUNT(*) FROM files WHERE user_id = ?', (g.user_id,)).fetchone()[0]
-    total_size = db.execute('SELECT SUM(size) FROM files WHERE user_id = ?', (g.user_id,)).fetchone()[0] or 0
+    stats = get_user_stats(g.user_id)
     
     return render_template('settings/limits.html', 
                          limits=limits, 
-                         total_files=total_files,
-                         total_size=total_size)
+                         total_files=stats['total_files'],
+                         total_size=stats['total_bytes'])
 
 # ==================== SYSTEM ====================
 
 @app.route('/health')
 def health():
     """System health (public, no auth)"""
-    db = get_db()
-    total_users = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    total_files = db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
-    total_size = db.execute('SELECT SUM(size) FROM files').fetchone()[0] or 0
+    stats = get_system_stats()
     
     return render_template('health.html', 
-                         total_users=total_users,
-                         total_files=total_files, 
-                         total_bytes=total_size)
+                         total_users=stats['total_users'],
+                         total_files=stats['total_files'], 
+                         total_bytes=stats['total_bytes'])
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -1,4 +1,5 @@
 import os
+import hmac
 import functools
 from flask import session, redirect, url_for, request, render_template
 
@@ -10,13 +11,18 @@ def login_required(view):
         return view(**kwargs)
     return wrapped_view
 
+@functools.lru_cache(maxsize=1)
+def _admin_password():
+    # Read once, on first use (after dotenv has populated the environment)
+    return os.getenv('ADMIN_PASSWORD', '').encode('utf-8')
+
 def verify_password(password):
     """
     Verifies the password against the backend configuration.
     Supports both plain text configuration and (future) hash checking.
     """
-    admin_password = os.getenv('ADMIN_PASSWORD')
-    # Simple direct comparison for this version as requested
-    if admin_password and password == admin_password:
+    admin_password = _admin_password()
+    # Constant-time comparison so response timing doesn't leak the password
+    if admin_password and hmac.compare_digest(admin_password, password.encode('utf-8')):
         return True
     return False
@@ -4,31 +4,125 @@ Handles user registration, login, session management, and decorators.
 """
 
 import bcrypt
-import secrets
-from datetime import datetime, timedelta
+from argon2 import PasswordHasher, Type
+from argon2.exceptions import VerificationError, InvalidHashError
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import session, redirect, url_for, g, request
-from db import get_db, get_user, get_user_by_email, create_user
+from db import get_db, connect, get_user_by_email, get_session_user, create_user
+from encryption import forget_bot_token
+import background
 
 # Session configuration
 SESSION_LIFETIME_HOURS = 24
+SESSION_TOUCH_INTERVAL_SECONDS = 60  # last_active is rewritten at most this often
+# Failed logins are counted per (client IP, email), so one address can't lock
+# other users out; a much higher per-IP ceiling still caps password spraying
 MAX_LOGIN_ATTEMPTS = 3
+MAX_LOGIN_ATTEMPTS_PER_IP = 50
 LOGIN_ATTEMPT_WINDOW_MINUTES = 5
+LOGIN_TRACKER_MAX_KEYS = 10000
 
-def hash_password(password):
-    """Hash password with bcrypt"""
+# Sessions deleted per statement when logging out everywhere
+SESSION_PURGE_BATCH = 500
+
+# New passwords use Argon2id (64 MiB, 2 passes, 2 lanes); bcrypt hashes
+# from older accounts are still accepted and upgraded on login
+_argon2 = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2, type=Type.ID)
+
+# Password hashing runs on a bounded pool; both hashers release the GIL, so
+# hashes run in parallel but never on more than HASH_WORKERS cores
+HASH_WORKERS = os.cpu_count() or 1
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+
+# Validated sessions (per process): session_token -> (user, expires_at, cached_at).
+# Entries are dropped whenever the session or its user row is changed here.
+SESSION_CACHE_TTL_SECONDS = 60
+SESSION_CACHE_MAX_ENTRIES = 10000
+_session_cache = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+# Failed login attempts: ('ip', ip) or ('account', ip, email) -> (failures, window_start)
+_login_failures = OrderedDict()
+_login_failures_lock = threading.Lock()
+
+def _bcrypt_hash(password):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
-def verify_password(password, password_hash):
-    """Verify password against hash"""
+def _bcrypt_check(password, password_hash):
     try:
         return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
     except:
         return False
 
+def _argon2_check(password, password_hash):
+    try:
+        return _argon2.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def hash_password(password):
+    """Hash password with Argon2id"""
+    return _hash_pool.submit(_argon2.hash, password).result()
+
+def verify_password(password, password_hash):
+    """Verify password against hash (Argon2id, or legacy bcrypt)"""
+    check = _argon2_check if password_hash.startswith('$argon2') else _bcrypt_check
+    return _hash_pool.submit(check, password, password_hash).result()
+
+def password_needs_rehash(password_hash):
+    """True for legacy bcrypt hashes and Argon2 hashes with outdated parameters"""
+    return not password_hash.startswith('$argon2') or _argon2.check_needs_rehash(password_hash)
+
+def _login_keys(ip_address, email):
+    """Tracker keys for a login attempt: (per-IP key, per-account key)"""
+    return ('ip', ip_address), ('account', ip_address, (email or '').strip().lower())
+
+def _failures_in_window(key, now):
+    """Failures counted for key in the current window (caller holds the lock)"""
+    entry = _login_failures.get(key)
+    if entry is None:
+        return 0
+    failures, window_start = entry
+    if now - window_start >= LOGIN_ATTEMPT_WINDOW_MINUTES * 60:
+        del _login_failures[key]
+        return 0
+    return failures
+
+def login_attempts_exceeded(ip_address, email):
+    """True if this email from this IP, or the IP overall, has used up its failed logins"""
+    ip_key, account_key = _login_keys(ip_address, email)
+    now = time.monotonic()
+    with _login_failures_lock:
+        return (_failures_in_window(account_key, now) >= MAX_LOGIN_ATTEMPTS
+                or _failures_in_window(ip_key, now) >= MAX_LOGIN_ATTEMPTS_PER_IP)
+
+def record_login_failure(ip_address, email):
+    """Count a failed login against the (IP, email) pair and the IP"""
+    now = time.monotonic()
+    with _login_failures_lock:
+        for key in _login_keys(ip_address, email):
+            failures = _failures_in_window(key, now)
+            window_start = _login_failures[key][1] if failures else now
+            _login_failures[key] = (failures + 1, window_start)
+            _login_failures.move_to_end(key)
+        while len(_login_failures) > LOGIN_TRACKER_MAX_KEYS:
+            _login_failures.popitem(last=False)
+
+def clear_login_failures(ip_address, email):
+    """Reset the (IP, email) failure count after a successful login (the per-IP count stays)"""
+    with _login_failures_lock:
+        _login_failures.pop(_login_keys(ip_address, email)[1], None)
+
 def generate_session_token():
-    """Generate secure random session token"""
-    return secrets.token_urlsafe(32)
+    """Generate secure random session token (same format as secrets.token_urlsafe(32))"""
+    return base64.urlsafe_b64encode(os.urandom(32)).rstrip(b'=').decode('ascii')
 
 def create_session(user_id, ip_address=None, user_agent=None):
     """Create new session for user"""
@@ -44,45 +138,134 @@ def create_session(user_id, ip_address=None, user_agent=None):
     
     return token
 
+# Per-request session statements, kept as constants so every call hands
+# sqlite3 the same string and hits the connection's prepared-statement cache
+_SQL_DELETE_SESSION = 'DELETE FROM sessions WHERE session_token = ?'
+_SQL_TOUCH_SESSION = '''
+    UPDATE sessions SET last_active = CURRENT_TIMESTAMP 
+    WHERE session_token = ? AND (last_active IS NULL OR last_active < datetime('now', ?))
+'''
+_SESSION_TOUCH_AGE = f'-{SESSION_TOUCH_INTERVAL_SECONDS} seconds'
+_SQL_VALIDATE_SESSION = '''
+    SELECT user_id, expires_at, last_active FROM sessions 
+    WHERE session_token = ?
+'''
+
+def _session_is_live(session_token, expires_at, last_active):
+    """
+    Check session expiry (deleting it if expired) and touch last_active.
+    Hot sessions skip the write: last_active is only refreshed once it is
+    SESSION_TOUCH_INTERVAL_SECONDS old.
+    """
+    db = get_db()
+    
+    # Check expiry
+    if datetime.now() > datetime.fromisoformat(expires_at):
+        # Session expired, delete it
+        db.execute(_SQL_DELETE_SESSION, (session_token,))
+        return False
+    
+    # last_active is CURRENT_TIMESTAMP (UTC)
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    if last_active and now_utc - datetime.fromisoformat(last_active) < timedelta(seconds=SESSION_TOUCH_INTERVAL_SECONDS):
+        return True
+    
+    # Update last_active (guarded so concurrent requests write it once)
+    db.execute(_SQL_TOUCH_SESSION, (session_token, _SESSION_TOUCH_AGE))
+    
+    return True
+
 def validate_session(session_token):
     """Validate session token and return user_id if valid"""
     db = get_db()
-    session_data = db.execute('''
-        SELECT user_id, expires_at FROM sessions 
-        WHERE session_token = ?
-    ''', (session_token,)).fetchone()
+    session_data = db.execute(_SQL_VALIDATE_SESSION, (session_token,)).fetchone()
     
-    if not session_data:
+    if not session_data or not _session_is_live(session_token, session_data['expires_at'], session_data['last_active']):
         return None
     
-    # Check expiry
-    expires_at = datetime.fromisoformat(session_data['expires_at'])
-    if datetime.now() > expires_at:
-        # Session expired, delete it
-        db.execute('DELETE FROM sessions WHERE session_token = ?', (session_token,))
-        db.commit()
+    return session_data['user_id']
+
+def load_session_user(session_token):
+    """
+    Validate session token and load its user with a single query.
+    Results are reused for SESSION_CACHE_TTL_SECONDS.
+    Returns the user dict if the session is valid, else None.
+    """
+    now = time.monotonic()
+    with _session_cache_lock:
+        entry = _session_cache.get(session_token)
+        if entry and now - entry[2] < SESSION_CACHE_TTL_SECONDS and datetime.now() <= entry[1]:
+            _session_cache.move_to_end(session_token)
+            return dict(entry[0])
+    
+    user = get_session_user(session_token)
+    if not user:
         return None
     
-    # Update last_active
-    db.execute('''
-        UPDATE sessions SET last_active = CURRENT_TIMESTAMP 
-        WHERE session_token = ?
-    ''', (session_token,))
-    db.commit()
+    expires_at = user.pop('session_expires_at')
+    last_active = user.pop('session_last_active')
+    if not _session_is_live(session_token, expires_at, last_active):
+        return None
     
-    return session_data['user_id']
+    with _session_cache_lock:
+        _session_cache[session_token] = (dict(user), datetime.fromisoformat(expires_at), now)
+        _session_cache.move_to_end(session_token)
+        while len(_session_cache) > SESSION_CACHE_MAX_ENTRIES:
+            _session_cache.popitem(last=False)
+    return user
+
+def forget_session(session_token):
+    """Drop a session from the validated-session cache"""
+    with _session_cache_lock:
+        _session_cache.pop(session_token, None)
+
+def forget_user_sessions(user_id):
+    """Drop all of a user's cached sessions (after its sessions or user row change)"""
+    with _session_cache_lock:
+        stale = [token for token, entry in _session_cache.items() if entry[0]['id'] == user_id]
+        for token in stale:
+            del _session_cache[token]
 
 def destroy_session(session_token):
     """Destroy a session"""
     db = get_db()
-    db.execute('DELETE FROM sessions WHERE session_token = ?', (session_token,))
+    db.execute(_SQL_DELETE_SESSION, (session_token,))
     db.commit()
+    forget_session(session_token)
+
+def _delete_session_batch(db, user_id, max_id):
+    """
+    Delete up to SESSION_PURGE_BATCH of a user's sessions with id <= max_id
+    (those that existed at revocation), returning how many went
+    """
+    cursor = db.execute('''
+        DELETE FROM sessions WHERE id IN (
+            SELECT id FROM sessions WHERE user_id = ? AND id <= ? LIMIT ?
+        )
+    ''', (user_id, max_id, SESSION_PURGE_BATCH))
+    return cursor.rowcount
+
+def _purge_user_sessions(user_id, max_id):
+    """Background: delete the rest of a user's revoked sessions in short batches"""
+    conn = connect()
+    try:
+        while _delete_session_batch(conn, user_id, max_id) == SESSION_PURGE_BATCH:
+            pass
+    finally:
+        conn.close()
 
 def destroy_all_user_sessions(user_id):
-    """Destroy all sessions for a user (logout everywhere)"""
+    """
+    Destroy all sessions for a user (logout everywhere).
+    The first batch is deleted inline so revocation is immediate for
+    normal accounts; any remainder is purged in the background. Sessions
+    created after this call (logging in again) are left alone.
+    """
     db = get_db()
-    db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-    db.commit()
+    max_id = db.execute('SELECT MAX(id) FROM sessions WHERE user_id = ?', (user_id,)).fetchone()[0]
+    if max_id is not None and _delete_session_batch(db, user_id, max_id) == SESSION_PURGE_BATCH:
+        background.submit(_purge_user_sessions, user_id, max_id)
+    forget_user_sessions(user_id)
 
 def get_user_sessions(user_id):
     """Get all active sessions for a user"""
@@ -124,9 +307,17 @@ def login_user(email, password):
     Authenticate user and create session.
     Returns (user_id, session_token, error) tuple.
     """
+    # Client address (the proxy's X-Forwarded-For is applied by ProxyFix in app.py)
+    ip_address = request.remote_addr if request else None
+    
+    # Refuse before doing any hashing work once over the limit
+    if login_attempts_exceeded(ip_address, email):
+        return None, None, f"Too many failed login attempts. Try again in {LOGIN_ATTEMPT_WINDOW_MINUTES} minutes."
+    
     # Get user
     user = get_user_by_email(email)
     if not user:
+        record_login_failure(ip_address, email)
         return None, None, "Invalid email or password"
     
     # Check account status
@@ -135,10 +326,19 @@ def login_user(email, password):
     
     # Verify password
     if not verify_password(password, user['password_hash']):
+        record_login_failure(ip_address, email)
         return None, None, "Invalid email or password"
     
+    clear_login_failures(ip_address, email)
+    
+    # Upgrade bcrypt (or outdated Argon2) hashes now that we have the password
+    if password_needs_rehash(user['password_hash']):
+        db = get_db()
+        db.execute('UPDATE users SET password_hash = ? WHERE id = ?', (hash_password(password), user['id']))
+        db.commit()
+        forget_user_sessions(user['id'])
+    
     # Create session
-    ip_address = request.remote_addr if request else None
     user_agent = request.headers.get('User-Agent') if request else None
     session_token = create_session(user['id'], ip_address, user_agent)
     
@@ -161,6 +361,8 @@ def update_user_telegram_credentials(user_id, bot_token_encrypted, channel_id, v
         WHERE id = ?
     ''', (bot_token_encrypted, channel_id, 1 if verified else 0, verified, user_id))
     db.commit()
+    forget_bot_token(user_id)
+    forget_user_sessions(user_id)
 
 def mark_credentials_verified(user_id, verified=True):
     """Mark user's Telegram credentials as verified or broken"""
@@ -172,51 +374,56 @@ def mark_credentials_verified(user_id, verified=True):
         WHERE id = ?
     ''', (1 if verified else 0, verified, user_id))
     db.commit()
+    forget_user_sessions(user_id)
 
 def mark_onboarding_complete(user_id):
     """Mark user's onboarding as complete"""
     db = get_db()
     db.execute('UPDATE users SET onboarding_completed = 1 WHERE id = ?', (user_id,))
     db.commit()
+    forget_user_sessions(user_id)
 
 # Decorators
 
+def _auth_gate(require_onboarded=False, require_creds=False):
+    """
+    Build an auth decorator that loads the session once per request.
+    When gates are stacked, the outermost one authenticates and the inner
+    ones only run their (in-memory) status checks against g.user.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if 'user' not in g:
+                if 'session_token' not in session:
+                    return redirect(url_for('login'))
+                
+                user = load_session_user(session['session_token'])
+                if not user:
+                    session.clear()
+                    return redirect(url_for('login'))
+                
+                # Store in g for request context
+                g.user_id = user['id']
+                g.user = user
+            
+            if require_onboarded and not g.user.get('onboarding_completed'):
+                return redirect(url_for('onboarding'))
+            if require_creds and not g.user.get('credentials_verified'):
+                return redirect(url_for('settings_telegram'))
+            
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
 def login_required(f):
     """Decorator to require authentication"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'session_token' not in session:
-            return redirect(url_for('login'))
-        
-        user_id = validate_session(session['session_token'])
-        if not user_id:
-            session.clear()
-            return redirect(url_for('login'))
-        
-        # Store in g for request context
-        g.user_id = user_id
-        g.user = get_user(user_id)
-        
-        return f(*args, **kwargs)
-    return decorated_function
+    return _auth_gate()(f)
 
 def onboarding_required(f):
-    """Decorator to ensure onboarding is complete"""
-    @wraps(f)
-    @login_required
-    def decorated_function(*args, **kwargs):
-        if not g.user.get('onboarding_completed'):
-            return redirect(url_for('onboarding'))
-        return f(*args, **kwargs)
-    return decorated_function
+    """Decorator to ensure onboarding is complete (implies login_required)"""
+    return _auth_gate(require_onboarded=True)(f)
 
 def credentials_required(f):
-    """Decorator to ensure Telegram credentials are verified"""
-    @wraps(f)
-    @login_required
-    @onboarding_required
-    def decorated_function(*args, **kwargs):
-        if not g.user.get('credentials_verified'):
-            return redirect(url_for('settings_telegram'))
-        return f(*args, **kwargs)
-    return decorated_function
+    """Decorator to ensure Telegram credentials are verified (implies onboarding_required)"""
+    return _auth_gate(require_onboarded=True, require_creds=True)(f)
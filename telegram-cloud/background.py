@@ -0,0 +1,26 @@
+"""
+Background task runner for TeleCloud.
+Runs slow follow-up work (e.g. Telegram cleanup) off the request thread.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKGROUND_WORKERS = 4
+
+_executor = ThreadPoolExecutor(max_workers=MAX_BACKGROUND_WORKERS, thread_name_prefix='background')
+
+def _run(fn, args, kwargs):
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        logger.exception("%s failed", getattr(fn, '__name__', fn))
+
+def submit(fn, *args, **kwargs):
+    """
+    Schedule fn(*args, **kwargs) on the background pool.
+    Errors are logged, never raised to the caller.
+    """
+    return _executor.submit(_run, fn, args, kwargs)
@@ -1,24 +1,74 @@
 import sqlite3
-import json
+import orjson
 import os
+import queue
+import threading
+from collections import OrderedDict
 from flask import g
+from utils.packing import pack_message_ids, pack_chunk_hashes
 
 DB_PATH = 'cloud.db'
-SCHEMA_VERSION = 2  # Multi-user schema
+SCHEMA_VERSION = 12  # Drop unused status covering index
+
+# Connections are reused across requests instead of being opened per request
+POOL_SIZE = (os.cpu_count() or 1) * 2
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+STATEMENT_CACHE_SIZE = 256  # sqlite3 default is 128
+
+# Columns read from g.user by views/templates (no password hash)
+USER_COLUMNS = (
+    'id, email, account_status, onboarding_completed, credentials_verified, '
+    'credentials_verified_at, bot_token_encrypted, channel_id'
+)
+_SESSION_USER_COLUMNS = ', '.join(f'u.{col.strip()}' for col in USER_COLUMNS.split(','))
+
+# Columns shown in file listings (chunk lists stay on disk)
+FILE_LIST_COLUMNS = 'id, filename, size, chunks, uploaded_chunks, status, created_at'
+
+# Recent-files cache (per process), valid while user_stats.version is unchanged
+RECENT_FILES_CACHE_MAX_ENTRIES = 10000
+
+_recent_files_cache = OrderedDict()  # user_id -> (version, limit, files)
+_recent_files_lock = threading.Lock()
+
+def connect():
+    """
+    Open a connection in autocommit mode with WAL enabled.
+    Safe to hand between threads; used by the request pool and worker threads.
+    """
+    # Room for every distinct statement the app runs, so none is ever re-prepared
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
 
 def get_db():
-    """Get database connection for current request"""
+    """Get database connection for current request (borrowed from the pool)"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _pool.get_nowait()
+        except queue.Empty:
+            db = connect()
+            db.row_factory = sqlite3.Row
+        g._database = db
     return db
 
 def close_db(e=None):
-    """Close database connection"""
-    db = getattr(g, '_database', None)
+    """Return the request's connection to the pool"""
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        if db.in_transaction:
+            db.rollback()
+        try:
+            _pool.put_nowait(db)
+        except queue.Full:
+            db.close()
 
 def get_schema_version(conn):
     """Get current database schema version"""
@@ -34,14 +84,22 @@ def set_schema_version(conn, version):
     """Set database schema version"""
     cursor = conn.cursor()
     cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
-    conn.commit()
+
+def _copy_database(src_path, dst_path):
+    """Copy via the SQLite backup API so pages still in the WAL are included"""
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
 
 def backup_database():
     """Create backup before migration"""
     if os.path.exists(DB_PATH):
         backup_path = f"{DB_PATH}.backup"
-        import shutil
-        shutil.copy2(DB_PATH, backup_path)
+        _copy_database(DB_PATH, backup_path)
         print(f"✓ Database backed up to {backup_path}")
         return backup_path
     return None
@@ -74,7 +132,6 @@ def migrate_to_v1(conn):
         )
     ''')
     
-    conn.commit()
     print("✓ Migrated to schema v1 (single-user)")
 
 def migrate_to_v2(conn):
@@ -109,7 +166,7 @@ def migrate_to_v2(conn):
     
     # 2. Add user_id to files table (if not exists)
     cursor.execute("PRAGMA table_info(files)")
-    columns = [col[1] for col in cursor.fetchall()]
+    columns = {col[1] for col in cursor.fetchall()}
     
     if 'user_id' not in columns:
         cursor.execute('ALTER TABLE files ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE')
@@ -168,7 +225,6 @@ def migrate_to_v2(conn):
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_user_id ON files(user_id)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_status ON files(status)')
     
-    conn.commit()
     print("✓ Migrated to schema v2 (multi-user)")
     
     # 7. Create admin user from .env if no users exist
@@ -176,6 +232,264 @@ def migrate_to_v2(conn):
     if cursor.fetchone()[0] == 0:
         print("→ No users found, will create admin on first run")
 
+def migrate_to_v3(conn):
+    """Aggregate stats: per-user and global counters maintained by triggers"""
+    cursor = conn.cursor()
+    
+    # 1. Per-user aggregates
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY,
+            total_files INTEGER NOT NULL DEFAULT 0,
+            completed_files INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # 2. Global aggregates (single row, id = 1)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS system_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            total_files INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # 3. Backfill from existing rows
+    cursor.execute('DELETE FROM user_stats')
+    cursor.execute('''
+        INSERT INTO user_stats (user_id, total_files, completed_files, total_bytes)
+        SELECT user_id, COUNT(*), SUM(status IS 'completed'), COALESCE(SUM(size), 0)
+        FROM files WHERE user_id IS NOT NULL GROUP BY user_id
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO system_stats (id, total_users, total_files, total_bytes)
+        SELECT 1, (SELECT COUNT(*) FROM users), COUNT(*), COALESCE(SUM(size), 0) FROM files
+    ''')
+    
+    # 4. Keep aggregates current on every write to files/users
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_stats_insert AFTER INSERT ON files
+        BEGIN
+            INSERT INTO user_stats (user_id, total_files, completed_files, total_bytes)
+            SELECT NEW.user_id, 1, NEW.status IS 'completed', COALESCE(NEW.size, 0)
+            WHERE NEW.user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET
+                total_files = total_files + 1,
+                completed_files = completed_files + excluded.completed_files,
+                total_bytes = total_bytes + excluded.total_bytes;
+            UPDATE system_stats
+            SET total_files = total_files + 1, total_bytes = total_bytes + COALESCE(NEW.size, 0)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_stats_delete AFTER DELETE ON files
+        BEGIN
+            UPDATE user_stats
+            SET total_files = total_files - 1,
+                completed_files = completed_files - (OLD.status IS 'completed'),
+                total_bytes = total_bytes - COALESCE(OLD.size, 0)
+            WHERE user_id = OLD.user_id;
+            UPDATE system_stats
+            SET total_files = total_files - 1, total_bytes = total_bytes - COALESCE(OLD.size, 0)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_stats_update AFTER UPDATE OF size, status ON files
+        BEGIN
+            UPDATE user_stats
+            SET completed_files = completed_files + (NEW.status IS 'completed') - (OLD.status IS 'completed'),
+                total_bytes = total_bytes + COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0)
+            WHERE user_id = NEW.user_id;
+            UPDATE system_stats
+            SET total_bytes = total_bytes + COALESCE(NEW.size, 0) - COALESCE(OLD.size, 0)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE system_stats SET total_users = total_users + 1 WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE system_stats SET total_users = total_users - 1 WHERE id = 1;
+        END
+    ''')
+    
+    print("✓ Migrated to schema v3 (aggregate stats)")
+
+def migrate_to_v4(conn):
+    """Covering index so upload status polls never touch the files table"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_status_cover 
+        ON files(user_id, id, status, uploaded_chunks, chunks)
+    ''')
+    print("✓ Migrated to schema v4 (status covering index)")
+
+def migrate_to_v5(conn):
+    """Daily upload counter on user_stats (incremented atomically per upload)"""
+    cursor = conn.cursor()
+    
+    cursor.execute("PRAGMA table_info(user_stats)")
+    columns = {col[1] for col in cursor.fetchall()}
+    
+    required = {
+        'uploads_today': 'INTEGER NOT NULL DEFAULT 0',
+        'day_bucket': 'INTEGER NOT NULL DEFAULT 0',
+    }
+    for name, definition in required.items():
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE user_stats ADD COLUMN {name} {definition}')
+    
+    # Seed today's counters from files created today (UTC day number)
+    cursor.execute('''
+        UPDATE user_stats
+        SET uploads_today = (
+                SELECT COUNT(*) FROM files 
+                WHERE files.user_id = user_stats.user_id AND DATE(created_at) = DATE('now')
+            ),
+            day_bucket = CAST(strftime('%s', 'now') AS INTEGER) / 86400
+    ''')
+    
+    print("✓ Migrated to schema v5 (daily upload counter)")
+
+def migrate_to_v6(conn):
+    """Store message_ids/chunk_hashes as JSON BLOBs (written with orjson)"""
+    cursor = conn.cursor()
+    
+    # Same JSON bytes, BLOB storage class: no text encoding round-trip on read
+    cursor.execute('''
+        UPDATE files
+        SET message_ids = CAST(message_ids AS BLOB),
+            chunk_hashes = CAST(chunk_hashes AS BLOB)
+        WHERE typeof(message_ids) = 'text' OR typeof(chunk_hashes) = 'text'
+    ''')
+    
+    print("✓ Migrated to schema v6 (JSON BLOB chunk lists)")
+
+def migrate_to_v7(conn):
+    """Index for per-user file listings (newest first)"""
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_user_created 
+        ON files(user_id, created_at DESC)
+    ''')
+    
+    print("✓ Migrated to schema v7 (file listing index)")
+
+def migrate_to_v8(conn):
+    """Per-user version counter, bumped by triggers on any change to a user's files"""
+    cursor = conn.cursor()
+    
+    cursor.execute("PRAGMA table_info(user_stats)")
+    columns = {col[1] for col in cursor.fetchall()}
+    
+    if 'version' not in columns:
+        cursor.execute('ALTER TABLE user_stats ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    
+    # Upsert so the bump works whichever stats trigger fires first
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_version_insert AFTER INSERT ON files
+        WHEN NEW.user_id IS NOT NULL
+        BEGIN
+            INSERT INTO user_stats (user_id, version) VALUES (NEW.user_id, 1)
+            ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_version_update AFTER UPDATE ON files
+        BEGIN
+            UPDATE user_stats SET version = version + 1 WHERE user_id IN (OLD.user_id, NEW.user_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_version_delete AFTER DELETE ON files
+        BEGIN
+            UPDATE user_stats SET version = version + 1 WHERE user_id = OLD.user_id;
+        END
+    ''')
+    
+    print("✓ Migrated to schema v8 (files version counter)")
+
+def migrate_to_v9(conn):
+    """Index for status-filtered listings; drop indexes made redundant by others"""
+    cursor = conn.cursor()
+    
+    # /files?status=... : index-order traversal instead of filter + sort
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_files_user_status_created 
+        ON files(user_id, status, created_at DESC)
+    ''')
+    
+    # Prefix of idx_files_user_created / duplicate of the session_token UNIQUE index
+    cursor.execute('DROP INDEX IF EXISTS idx_files_user_id')
+    cursor.execute('DROP INDEX IF EXISTS idx_sessions_token')
+    
+    print("✓ Migrated to schema v9 (listing indexes)")
+
+def migrate_to_v10(conn):
+    """Per-chunk Telegram file_ids (JSON BLOB), so downloads can call getFile directly"""
+    cursor = conn.cursor()
+    
+    cursor.execute("PRAGMA table_info(files)")
+    columns = {col[1] for col in cursor.fetchall()}
+    
+    # NULL for files uploaded before v10; their chunks are resolved by forwarding
+    if 'chunk_file_ids' not in columns:
+        cursor.execute('ALTER TABLE files ADD COLUMN chunk_file_ids BLOB')
+    
+    print("✓ Migrated to schema v10 (chunk file_ids)")
+
+def migrate_to_v11(conn):
+    """Re-encode message_ids/chunk_hashes from JSON to packed binary (see utils/packing.py)"""
+    cursor = conn.cursor()
+    
+    rows = cursor.execute('SELECT id, message_ids, chunk_hashes FROM files').fetchall()
+    for file_id, message_ids, chunk_hashes in rows:
+        cursor.execute(
+            'UPDATE files SET message_ids = ?, chunk_hashes = ? WHERE id = ?',
+            (pack_message_ids(orjson.loads(message_ids or b'[]')),
+             pack_chunk_hashes(orjson.loads(chunk_hashes or b'[]')),
+             file_id)
+        )
+    
+    print(f"✓ Migrated to schema v11 (packed chunk lists, {len(rows)} files)")
+
+def migrate_to_v12(conn):
+    """Drop idx_files_status_cover: status lookups go by rowid, the index only cost writes"""
+    cursor = conn.cursor()
+    
+    # WHERE user_id = ? AND id = ? is planned as a rowid probe, so the index was
+    # never read, but every per-chunk uploaded_chunks UPDATE rewrote it
+    cursor.execute('DROP INDEX IF EXISTS idx_files_status_cover')
+    
+    print("✓ Migrated to schema v12 (dropped status covering index)")
+
+MIGRATIONS = [
+    (1, migrate_to_v1),
+    (2, migrate_to_v2),
+    (3, migrate_to_v3),
+    (4, migrate_to_v4),
+    (5, migrate_to_v5),
+    (6, migrate_to_v6),
+    (7, migrate_to_v7),
+    (8, migrate_to_v8),
+    (9, migrate_to_v9),
+    (10, migrate_to_v10),
+    (11, migrate_to_v11),
+    (12, migrate_to_v12),
+]
+
 def init_db():
     """
     Initialize database with migrations.
@@ -187,22 +501,27 @@ def init_db():
     backup_path = backup_database()
     
     try:
-        conn = sqlite3.connect(DB_PATH)
+        # Explicit transaction control: all pending migrations commit together
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
         current_version = get_schema_version(conn)
         
         print(f"Current schema version: v{current_version}")
         print(f"Target schema version: v{SCHEMA_VERSION}")
         
-        # Apply migrations in order
-        if current_version < 1:
-            migrate_to_v1(conn)
-            set_schema_version(conn, 1)
-            current_version = 1
-        
-        if current_version < 2:
-            migrate_to_v2(conn)
-            set_schema_version(conn, 2)
-            current_version = 2
+        pending = [(version, migrate) for version, migrate in MIGRATIONS if version > current_version]
+        if pending:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Apply migrations in order
+                for version, migrate in pending:
+                    migrate(conn)
+                    set_schema_version(conn, version)
+                    current_version = version
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                conn.close()
+                raise
         
         conn.close()
         print(f"✓ Database initialization complete (v{current_version})")
@@ -211,8 +530,7 @@ def init_db():
         print(f"✗ Migration failed: {e}")
         if backup_path:
             print(f"Restoring from backup: {backup_path}")
-            import shutil
-            shutil.copy2(backup_path, DB_PATH)
+            _copy_database(backup_path, DB_PATH)
             print("✓ Database restored from backup")
         raise
 
@@ -221,13 +539,29 @@ def init_db():
 def get_user(user_id):
     """Get user by ID"""
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    user = db.execute(f'SELECT {USER_COLUMNS} FROM users WHERE id = ?', (user_id,)).fetchone()
+    return dict(user) if user else None
+
+def get_user_password_hash(user_id):
+    """Get a user's password hash (kept out of get_user/g.user)"""
+    db = get_db()
+    row = db.execute('SELECT password_hash FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row['password_hash'] if row else None
+
+def get_session_user(session_token):
+    """Get the user owning a session token, plus the session expiry/last_active, in one query"""
+    db = get_db()
+    user = db.execute(f'''
+        SELECT {_SESSION_USER_COLUMNS}, s.expires_at AS session_expires_at, s.last_active AS session_last_active
+        FROM sessions s JOIN users u ON u.id = s.user_id
+        WHERE s.session_token = ?
+    ''', (session_token,)).fetchone()
     return dict(user) if user else None
 
 def get_user_by_email(email):
-    """Get user by email"""
+    """Get login fields (id, password_hash, account_status) of a user by email"""
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+    user = db.execute('SELECT id, password_hash, account_status FROM users WHERE email = ?', (email,)).fetchone()
     return dict(user) if user else None
 
 def create_user(email, password_hash, bot_token_encrypted=None, channel_id=None):
@@ -242,19 +576,81 @@ def create_user(email, password_hash, bot_token_encrypted=None, channel_id=None)
     db.commit()
     return cursor.lastrowid
 
-def get_user_files(user_id, status=None):
-    """Get all files for a user, optionally filtered by status"""
+def create_file_entry(user_id, filename, size):
+    """Create the 'uploading' row for a new upload and return its id"""
+    db = get_db()
+    cursor = db.execute('''
+        INSERT INTO files (user_id, filename, size, chunks, status, message_ids, chunk_hashes) 
+        VALUES (?, ?, ?, 0, 'uploading', X'', X'')
+    ''', (user_id, filename, size))
+    db.commit()
+    return cursor.lastrowid
+
+def get_user_files(user_id, status=None, limit=None, search=None):
+    """
+    Get files for a user (newest first), optionally filtered by status,
+    case-insensitive filename substring (search) and capped at limit.
+    Returns sqlite3.Row objects with the FILE_LIST_COLUMNS only.
+    """
     db = get_db()
+    sql = f'SELECT {FILE_LIST_COLUMNS} FROM files WHERE user_id = ?'
+    params = [user_id]
     if status:
-        files = db.execute('SELECT * FROM files WHERE user_id = ? AND status = ? ORDER BY created_at DESC', 
-                          (user_id, status)).fetchall()
-    else:
-        files = db.execute('SELECT * FROM files WHERE user_id = ? ORDER BY created_at DESC', 
-                          (user_id,)).fetchall()
-    return [dict(f) for f in files]
+        sql += ' AND status = ?'
+        params.append(status)
+    if search:
+        pattern = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        sql += " AND filename LIKE ? ESCAPE '\\'"
+        params.append(f'%{pattern}%')
+    sql += ' ORDER BY created_at DESC'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return db.execute(sql, params).fetchall()
+
+def get_recent_files(user_id, version, limit=20):
+    """
+    Get a user's newest files, reusing the last result while the user's
+    files version (from get_user_stats) is unchanged.
+    """
+    with _recent_files_lock:
+        entry = _recent_files_cache.get(user_id)
+        if entry and entry[0] == version and entry[1] == limit:
+            _recent_files_cache.move_to_end(user_id)
+            return entry[2]
+    
+    files = get_user_files(user_id, limit=limit)
+    with _recent_files_lock:
+        _recent_files_cache[user_id] = (version, limit, files)
+        _recent_files_cache.move_to_end(user_id)
+        while len(_recent_files_cache) > RECENT_FILES_CACHE_MAX_ENTRIES:
+            _recent_files_cache.popitem(last=False)
+    return files
+
+def get_user_stats(user_id):
+    """Get a user's file count/size aggregates and files version (O(1), kept current by triggers)"""
+    db = get_db()
+    stats = db.execute('SELECT total_files, completed_files, total_bytes, version FROM user_stats WHERE user_id = ?', 
+                       (user_id,)).fetchone()
+    return dict(stats) if stats else {'total_files': 0, 'completed_files': 0, 'total_bytes': 0, 'version': 0}
+
+def get_system_stats():
+    """Get global user/file/size aggregates (O(1), kept current by triggers)"""
+    db = get_db()
+    stats = db.execute('SELECT total_users, total_files, total_bytes FROM system_stats WHERE id = 1').fetchone()
+    return dict(stats) if stats else {'total_users': 0, 'total_files': 0, 'total_bytes': 0}
 
 def get_user_file(user_id, file_id):
     """Get specific file for a user (ensures isolation)"""
     db = get_db()
     file = db.execute('SELECT * FROM files WHERE id = ? AND user_id = ?', (file_id, user_id)).fetchone()
     return dict(file) if file else None
+
+def get_file_status(user_id, file_id):
+    """Get upload status columns for a user's file (a single rowid lookup)"""
+    db = get_db()
+    file = db.execute('''
+        SELECT status, uploaded_chunks, chunks FROM files 
+        WHERE user_id = ? AND id = ?
+    ''', (user_id, file_id)).fetchone()
+    return dict(file) if file else None
@@ -1,14 +1,37 @@
-import json
+import orjson
+import hmac
+import logging
+import queue
+import socket
+import threading
+import time
 import requests
-import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import urllib3
+from collections import OrderedDict, deque
+from utils.hasher import new_sha256
+from utils.packing import unpack_message_ids, chunk_digest
 from telegram_client import TelegramClient
 
+logger = logging.getLogger(__name__)
+
 # TRUE STREAMING configuration
-STREAM_BLOCK_SIZE = 524288  # 512KB - optimal for network + memory balance
-PREFETCH_CHUNKS = 2         # Conservative prefetch for true streaming
-MAX_WORKERS = 3             # Reduced workers (true streaming needs less)
-CHUNK_TIMEOUT = 120
+STREAM_BLOCK_SIZE = 524288  # 512KB - smallest block; also used when the socket buffer size is unknown
+MAX_BLOCK_SIZE = 4194304    # Blocks grow with the socket's SO_RCVBUF up to 4MB
+PREFETCH_CHUNKS = 3         # Chunks downloaded ahead of the one being sent (4 bodies at once)
+CHUNK_TIMEOUT = 120         # Per read: a body that stalls longer is dropped and resumed
+CHUNK_RESUMES = 3           # Times one chunk's body is re-requested from where it stopped
+READ_AHEAD_BLOCKS = 4       # Blocks per chunk read from Telegram ahead of the client
+
+# getFile results (per process): file_id -> (file_path, fetched_at).
+# Telegram keeps a file_path downloadable for at least an hour.
+FILE_PATH_TTL_SECONDS = 3000
+FILE_PATH_CACHE_MAX_ENTRIES = 10000
+_file_path_cache = OrderedDict()
+_file_path_cache_lock = threading.Lock()
+
+# A body read that failed part-way (timeout, reset) and can be resumed with a Range request
+_BODY_READ_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                     urllib3.exceptions.HTTPError)
 
 def prepare_download_data(file_id, db_connection, bot_token, channel_id):
     """
@@ -16,7 +39,10 @@ def prepare_download_data(file_id, db_connection, bot_token, channel_id):
     This function operates WITHIN the Flask request context.
     Returns a dict with all data needed for streaming.
     """
-    row = db_connection.execute('SELECT * FROM files WHERE id = ?', (file_id,)).fetchone()
+    row = db_connection.execute('''
+        SELECT filename, size, chunks, status, message_ids, chunk_hashes, chunk_file_ids
+        FROM files WHERE id = ?
+    ''', (file_id,)).fetchone()
     
     if not row:
         return None
@@ -24,8 +50,11 @@ def prepare_download_data(file_id, db_connection, bot_token, channel_id):
     if row['status'] != 'completed':
         return {'error': 'File not ready for download', 'code': 400}
         
-    message_ids = json.loads(row['message_ids'])
-    chunk_hashes = json.loads(row['chunk_hashes'])
+    message_ids = unpack_message_ids(row['message_ids'])
+    # Packed digests: each chunk slices its own 32 bytes when its turn comes
+    chunk_hashes = memoryview(row['chunk_hashes'])
+    # Files uploaded before chunk file_ids were stored have none
+    chunk_file_ids = orjson.loads(row['chunk_file_ids']) if row['chunk_file_ids'] else [None] * len(message_ids)
     
     if not message_ids:
         return {'error': 'No chunks found for file', 'code': 500}
@@ -36,25 +65,48 @@ def prepare_download_data(file_id, db_connection, bot_token, channel_id):
         'size': row['size'],
         'message_ids': message_ids,
         'chunk_hashes': chunk_hashes,
+        'chunk_file_ids': chunk_file_ids,
         'chunks': row['chunks'],
         'bot_token': bot_token,
         'channel_id': channel_id
     }
 
 
-def stream_single_chunk_verified(client, msg_id, expected_hash, chunk_index):
-    """
-    Stream a single chunk with INCREMENTAL hash verification.
-    
-    TRUE STREAMING IMPLEMENTATION:
-    - Uses requests.get(stream=True)
-    - Yields small blocks (512KB) immediately
-    - Computes hash incrementally (no full buffering)
-    - Verifies at the end
+def _get_file_path(client, file_id):
+    """getFile, reusing a result fetched within FILE_PATH_TTL_SECONDS"""
+    now = time.monotonic()
+    with _file_path_cache_lock:
+        entry = _file_path_cache.get(file_id)
+        if entry and now - entry[1] < FILE_PATH_TTL_SECONDS:
+            return entry[0]
     
-    Returns:
-        Generator yielding bytes + final hash
+    file_path = client.get_file_path(file_id)
+    with _file_path_cache_lock:
+        _file_path_cache[file_id] = (file_path, now)
+        _file_path_cache.move_to_end(file_id)
+        while len(_file_path_cache) > FILE_PATH_CACHE_MAX_ENTRIES:
+            _file_path_cache.popitem(last=False)
+    return file_path
+
+def forget_file_path(file_id):
+    """Drop a cached getFile result; returns True if there was one"""
+    with _file_path_cache_lock:
+        return _file_path_cache.pop(file_id, None) is not None
+
+
+def resolve_chunk_url(client, msg_id, chunk_index, file_id=None):
     """
+    Get a download URL for one chunk.
+    Uses the file_id stored at upload time (one getFile call, cached); falls
+    back to forwarding the message for a fresh file_id if there is none or it fails.
+    """
+    if file_id:
+        try:
+            file_path = _get_file_path(client, file_id)
+            return client.get_file_download_url(file_path)
+        except requests.exceptions.RequestException as e:
+            logger.info("Stored file_id for chunk %d rejected, forwarding instead: %s", chunk_index + 1, e)
+    
     # 1. Get fresh file_id from Telegram
     forwarded_msg = client.forward_message(client.channel_id, client.channel_id, msg_id)
     
@@ -68,35 +120,102 @@ def stream_single_chunk_verified(client, msg_id, expected_hash, chunk_index):
     
     # 3. Get direct CDN download URL
     file_path = client.get_file_path(file_id_remote)
-    download_url = client.get_file_download_url(file_path)
+    return client.get_file_download_url(file_path)
+
+
+def stream_block_size(response):
+    """
+    Pick a read size from the kernel receive buffer of the response's socket:
+    big buffers (fast links) get bigger blocks and fewer reads. Never below
+    STREAM_BLOCK_SIZE, which is also used if the socket is unavailable.
+    """
+    try:
+        sock = response.raw.connection.sock
+        rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    except (AttributeError, OSError):
+        return STREAM_BLOCK_SIZE
+    return max(min(rcvbuf, MAX_BLOCK_SIZE), STREAM_BLOCK_SIZE)
+
+
+def read_hashed_blocks(response, sha256_hash, block_size=None):
+    """
+    Read a streaming response body straight from response.raw, hashing each
+    block before yielding it. Skips iter_content's per-block generator
+    layers and decode step; the block urllib3 returns is passed on as is.
+    """
+    block_size = block_size or stream_block_size(response)
+    while True:
+        block = response.raw.read(block_size)
+        if not block:
+            break
+        sha256_hash.update(block)
+        yield block
+
+
+def _open_chunk(client, msg_id, chunk_index, file_id, offset=0):
+    """
+    Start the streaming GET for a chunk (from offset onwards), re-resolving
+    once if a cached file_path has gone stale.
+    """
+    url = resolve_chunk_url(client, msg_id, chunk_index, file_id)
+    response = client.open_download(url, CHUNK_TIMEOUT, offset)
+    if response.status_code == 404 and file_id and forget_file_path(file_id):
+        response.close()
+        url = resolve_chunk_url(client, msg_id, chunk_index, file_id)
+        response = client.open_download(url, CHUNK_TIMEOUT, offset)
+    return response
+
+
+def stream_single_chunk_verified(client, msg_id, expected_digest, chunk_index, file_id=None):
+    """
+    Stream a single chunk with INCREMENTAL hash verification.
     
-    # 4. TRUE STREAMING: Download and compute hash incrementally
-    sha256_hash = hashlib.sha256()
+    TRUE STREAMING IMPLEMENTATION:
+    - Uses a streaming GET on the shared keep-alive session
+    - Yields small blocks (512KB) immediately
+    - Computes hash incrementally (no full buffering)
+    - A body that stalls or drops part-way (e.g. it sat idle behind a slow
+      client) is re-requested from the byte it stopped at, up to CHUNK_RESUMES times
+    - Verifies at the end
     
-    # CRITICAL: stream=True enables true streaming from Telegram CDN
-    with requests.get(download_url, stream=True, timeout=CHUNK_TIMEOUT) as response:
-        response.raise_for_status()
-        
-        # Stream bytes in small blocks
-        # iter_content() reads from socket incrementally (no full buffering)
-        for block in response.iter_content(chunk_size=STREAM_BLOCK_SIZE):
-            if block:  # Filter out keep-alive chunks
-                # Update hash incrementally
-                sha256_hash.update(block)
+    Returns:
+        Generator yielding bytes + final hash
+    """
+    # TRUE STREAMING: Download and compute hash incrementally
+    sha256_hash = new_sha256()
+    received = 0
+    resumes = 0
+    
+    while True:
+        try:
+            # CRITICAL: stream=True enables true streaming from Telegram CDN
+            # Pooled keep-alive connection: no new TLS handshake per chunk
+            with _open_chunk(client, msg_id, chunk_index, file_id, received) as response:
+                response.raise_for_status()
+                if received and response.status_code != 206:
+                    raise Exception(f"Chunk {chunk_index+1}: Range request not honoured, cannot resume")
                 
-                # Yield immediately to client
+                # Stream bytes in small blocks, hashing incrementally (no full buffering)
                 # This is PIPE-STYLE streaming: Telegram → Server → Client
-                yield block
+                for block in read_hashed_blocks(response, sha256_hash):
+                    received += len(block)
+                    yield block
+            break
+        except _BODY_READ_ERRORS as e:
+            if resumes == CHUNK_RESUMES:
+                raise
+            resumes += 1
+            logger.info("Chunk %d body dropped after %d bytes, resuming: %s", chunk_index + 1, received, e)
     
     # 5. Verify hash after streaming completes
-    computed_hash = sha256_hash.hexdigest()
-    if computed_hash != expected_hash:
+    computed_digest = sha256_hash.digest()
+    if not hmac.compare_digest(computed_digest, expected_digest):
         raise Exception(
             f"Chunk {chunk_index+1}: Hash mismatch after streaming. "
-            f"Expected {expected_hash}, got {computed_hash}"
+            f"Expected {expected_digest.hex()}, got {computed_digest.hex()}"
         )
     
-    print(f"[TrueStream] Chunk {chunk_index+1} streamed and verified: {computed_hash[:8]}...")
+    logger.debug("Chunk %d streamed and verified: %s...", chunk_index + 1, computed_digest[:4].hex())
 
 
 def create_download_stream(download_data):
@@ -108,7 +227,9 @@ def create_download_stream(download_data):
     - Streams 512KB blocks directly from Telegram CDN to client
     - Telegram → Server → Client happens SIMULTANEOUSLY
     - Hash verification is incremental (no waiting)
-    - Memory usage: ~1-2MB max (block size × prefetch)
+    - Memory usage: bounded, READ_AHEAD_BLOCKS blocks per chunk in flight
+    - Telegram connections: at most PREFETCH_CHUNKS + 1 bodies at once; a
+      prefetched body left idle by a slow client is resumed, not failed
     
     OLD (SLOW):
     1. Download full chunk A from Telegram (20MB, 5 seconds)
@@ -133,87 +254,84 @@ def create_download_stream(download_data):
     """
     message_ids = download_data['message_ids']
     chunk_hashes = download_data['chunk_hashes']
-    bot_token = download_data['bot_token']
-    channel_id = download_data['channel_id']
-    client = TelegramClient(token=bot_token, channel_id=channel_id)
+    chunk_file_ids = download_data['chunk_file_ids']
+    client = TelegramClient(token=download_data['bot_token'], channel_id=download_data['channel_id'])
     
-    # Stream each chunk in order
-    for i, msg_id in enumerate(message_ids):
-        try:
-            # Stream this chunk with incremental verification
-            for block in stream_single_chunk_verified(
-                client, 
-                msg_id, 
-                chunk_hashes[i], 
-                i
-            ):
-                # Yield directly to Flask Response
-                # This goes straight to the client's socket
-                yield block
-                
-        except Exception as e:
-            print(f"[TrueStream] Error at chunk {i+1}/{len(message_ids)}: {e}")
-            raise
+    def start_chunk(i):
+        # Each chunk is fetched and verified on its own read-ahead thread
+        return _ReadAhead(stream_single_chunk_verified(
+            client, message_ids[i], chunk_digest(chunk_hashes, i), i, chunk_file_ids[i]
+        ))
+    
+    # The chunk being sent plus up to PREFETCH_CHUNKS after it download at once;
+    # blocks still reach the client strictly in order
+    pending = deque()
+    next_chunk = 0
+    try:
+        for i in range(len(message_ids)):
+            while next_chunk < len(message_ids) and next_chunk <= i + PREFETCH_CHUNKS:
+                pending.append(start_chunk(next_chunk))
+                next_chunk += 1
+            
+            current = pending.popleft()
+            try:
+                yield from current
+            except Exception as e:
+                logger.error("Error at chunk %d/%d: %s", i + 1, len(message_ids), e)
+                raise
+            finally:
+                current.close()
+    finally:
+        for reader in pending:
+            reader.close()
 
 
-def create_download_stream_prefetch(download_data):
+class _ReadAhead:
     """
-    ADVANCED: True streaming WITH chunk prefetching.
-    
-    OPTIMIZATION:
-    - Prefetch next chunk's metadata while current chunk streams
-    - Start next download as soon as previous completes
-    - Still maintains strict order
-    - Still streams blocks immediately
-    
-    TRADEOFF:
-    - More complex
-    - Needs careful backpressure handling
-    - Marginal improvement over simple streaming
-    
-    Use this ONLY if simple streaming isn't fast enough.
+    Pull blocks from a generator on a worker thread, up to depth ahead of
+    the consumer. Reading starts as soon as this is created. Producer errors
+    are re-raised to the consumer; close() (e.g. client disconnected) stops
+    the producer.
     """
-    message_ids = download_data['message_ids']
-    chunk_hashes = download_data['chunk_hashes']
-    client = TelegramClient()
-    
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        # Prefetch download URL for next chunk
-        def get_download_url(msg_id):
-            forwarded_msg = client.forward_message(client.channel_id, client.channel_id, msg_id)
-            file_id = forwarded_msg['document']['file_id']
-            client.delete_message(forwarded_msg['message_id'])
-            file_path = client.get_file_path(file_id)
-            return client.get_file_download_url(file_path)
-        
-        # Start first chunk
-        future = executor.submit(get_download_url, message_ids[0]) if message_ids else None
-        
-        for i, msg_id in enumerate(message_ids):
-            # Get URL (from prefetch or fresh)
-            download_url = future.result() if future else None
-            
-            # Start prefetching next chunk's URL
-            if i + 1 < len(message_ids):
-                future = executor.submit(get_download_url, message_ids[i + 1])
-            else:
-                future = None
-            
-            # Stream current chunk
-            sha256_hash = hashlib.sha256()
-            with requests.get(download_url, stream=True, timeout=CHUNK_TIMEOUT) as response:
-                response.raise_for_status()
-                for block in response.iter_content(chunk_size=STREAM_BLOCK_SIZE):
-                    if block:
-                        sha256_hash.update(block)
-                        yield block
-            
-            # Verify
-            computed_hash = sha256_hash.hexdigest()
-            if computed_hash != chunk_hashes[i]:
-                raise Exception(f"Chunk {i+1} hash mismatch")
-            
-            print(f"[TrueStream+Prefetch] Chunk {i+1} done")
+    _DONE = object()
+
+    def __init__(self, blocks, depth=READ_AHEAD_BLOCKS):
+        self._blocks = blocks
+        self._buffer = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        threading.Thread(target=self._produce, name='download-read-ahead', daemon=True).start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for block in self._blocks:
+                if not self._put(block):
+                    return
+            self._put(self._DONE)
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._blocks.close()
+
+    def close(self):
+        self._stop.set()
+
+    def __iter__(self):
+        while True:
+            item = self._buffer.get()
+            if item is self._DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
 
 
 def get_file_info(file_id, db_connection):
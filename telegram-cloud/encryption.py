@@ -4,22 +4,44 @@ Encrypts bot tokens at rest using Fernet (symmetric encryption).
 """
 
 from cryptography.fernet import Fernet
+from collections import OrderedDict
 import base64
 import hashlib
+import logging
 import os
+import threading
+import time
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Decrypted token cache (per process)
+TOKEN_CACHE_TTL_SECONDS = 300
+TOKEN_CACHE_MAX_ENTRIES = 10000
+
+_token_cache = OrderedDict()  # user_id -> (ciphertext digest, token, expires_at)
+_token_cache_lock = threading.Lock()
 
 def get_encryption_key():
     """
     Derive encryption key from SECRET_KEY in environment.
     Uses consistent key derivation so same SECRET_KEY = same encryption key.
     """
-    secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
-    
+    return _derive_key(os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production'))
+
+# Keyed on the secret rather than computed at import: .env may be loaded
+# after this module, and a changed SECRET_KEY gets a fresh key
+@lru_cache(maxsize=1)
+def _derive_key(secret_key):
     # Derive 32-byte key from secret using SHA256
     key_material = hashlib.sha256(secret_key.encode()).digest()
     # Fernet requires base64-encoded 32-byte key
     return base64.urlsafe_b64encode(key_material)
 
+@lru_cache(maxsize=1)
+def _get_fernet(key):
+    return Fernet(key)
+
 def encrypt_bot_token(plaintext_token):
     """
     Encrypt bot token for storage.
@@ -28,8 +50,7 @@ def encrypt_bot_token(plaintext_token):
     if not plaintext_token:
         return None
     
-    key = get_encryption_key()
-    f = Fernet(key)
+    f = _get_fernet(get_encryption_key())
     encrypted = f.encrypt(plaintext_token.encode())
     return encrypted.decode()
 
@@ -42,10 +63,41 @@ def decrypt_bot_token(encrypted_token):
         return None
     
     try:
-        key = get_encryption_key()
-        f = Fernet(key)
+        f = _get_fernet(get_encryption_key())
         decrypted = f.decrypt(encrypted_token.encode())
         return decrypted.decode()
     except Exception as e:
-        print(f"Decryption error: {e}")
+        logger.error("Decryption error: %s", e)
         return None
+
+def get_bot_token(user_id, encrypted_token):
+    """
+    Decrypt a user's bot token, reusing the result for TOKEN_CACHE_TTL_SECONDS.
+    Entries are keyed on a digest of the ciphertext, so a changed token is
+    never served from the cache.
+    """
+    if not encrypted_token:
+        return None
+    
+    digest = hashlib.blake2b(encrypted_token.encode(), digest_size=8).digest()
+    now = time.monotonic()
+    
+    with _token_cache_lock:
+        entry = _token_cache.get(user_id)
+        if entry and entry[0] == digest and entry[2] > now:
+            _token_cache.move_to_end(user_id)
+            return entry[1]
+    
+    token = decrypt_bot_token(encrypted_token)
+    if token is not None:
+        with _token_cache_lock:
+            _token_cache[user_id] = (digest, token, now + TOKEN_CACHE_TTL_SECONDS)
+            _token_cache.move_to_end(user_id)
+            while len(_token_cache) > TOKEN_CACHE_MAX_ENTRIES:
+                _token_cache.popitem(last=False)
+    return token
+
+def forget_bot_token(user_id):
+    """Drop a user's cached token (call when credentials change)"""
+    with _token_cache_lock:
+        _token_cache.pop(user_id, None)
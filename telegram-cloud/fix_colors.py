@@ -31,6 +31,12 @@ def fix_templates():
         r'text-blue-800': 'text-ag-blue-800',
     }
 
+    # One scan per file: all patterns in a single alternation, longest first
+    # so e.g. bg-cyan-500 wins over its prefix bg-cyan-50
+    pattern = re.compile('|'.join(
+        re.escape(old) for old in sorted(replacements, key=len, reverse=True)
+    ))
+
     for root, dirs, files in os.walk(template_dir):
         for file in files:
             if file.endswith('.html'):
@@ -38,9 +44,7 @@ def fix_templates():
                 with open(path, 'r', encoding='utf-8') as f:
                     content = f.read()
                 
-                new_content = content
-                for old, new in replacements.items():
-                    new_content = new_content.replace(old, new)
+                new_content = pattern.sub(lambda m: replacements[m.group(0)], content)
                 
                 if new_content != content:
                     print(f"Fixed {path}")
@@ -0,0 +1,45 @@
+"""
+Logging setup for TeleCloud.
+Records are put on a queue by the calling thread and formatted/written by
+a QueueListener thread, so request and upload threads never block on
+console or file I/O.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+_listener = None
+
+def setup_logging():
+    """
+    Route all logging through a queue (idempotent).
+    LOG_LEVEL sets the level (default INFO); LOG_FILE adds a rotating file.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    
+    formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    handlers = [logging.StreamHandler()]
+    log_file = os.getenv('LOG_FILE')
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,68 @@
+"""
+In-memory upload progress for TeleCloud.
+Upload workers publish here after every chunk so status polls can be
+answered without a database query. Entries only exist while an upload is
+running in this process; callers fall back to the database on a miss.
+Subscribers (the /events stream) get every update for their user pushed
+to a queue instead of polling.
+"""
+
+import queue
+import threading
+
+# Updates buffered per subscriber before new ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+_progress = {}  # file_id -> (user_id, status, uploaded_chunks, total_chunks)
+_subscribers = {}  # user_id -> set of queue.Queue
+_lock = threading.Lock()
+
+def _publish(user_id, file_id, status, uploaded, total):
+    """Push an update to the user's subscribers (caller holds _lock)"""
+    event = {'file_id': file_id, 'status': status, 'uploaded': uploaded, 'total': total}
+    for updates in _subscribers.get(user_id, ()):
+        try:
+            updates.put_nowait(event)
+        except queue.Full:
+            pass  # Reader is stalled; it will get the next update
+
+def update(file_id, user_id, status, uploaded, total):
+    """Record the latest progress of a running upload"""
+    with _lock:
+        _progress[file_id] = (user_id, status, uploaded, total)
+        _publish(user_id, file_id, status, uploaded, total)
+
+def get(user_id, file_id):
+    """
+    Get progress of a running upload owned by user_id.
+    Returns (status, uploaded, total) or None if not tracked here.
+    """
+    with _lock:
+        entry = _progress.get(file_id)
+    if entry is None or entry[0] != user_id:
+        return None
+    return entry[1:]
+
+def finish(file_id, status):
+    """Publish an upload's final status and stop tracking it (the database holds its final state)"""
+    with _lock:
+        entry = _progress.pop(file_id, None)
+        if entry is not None:
+            user_id, _, uploaded, total = entry
+            _publish(user_id, file_id, status, uploaded, total)
+
+def subscribe(user_id):
+    """Register a queue that receives every progress update for user_id"""
+    updates = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    with _lock:
+        _subscribers.setdefault(user_id, set()).add(updates)
+    return updates
+
+def unsubscribe(user_id, updates):
+    """Remove a queue registered with subscribe()"""
+    with _lock:
+        subscribers = _subscribers.get(user_id)
+        if subscribers is not None:
+            subscribers.discard(updates)
+            if not subscribers:
+                del _subscribers[user_id]
@@ -3,6 +3,7 @@ Rate limiting system for TeleCloud.
 Enforces free-tier limits: 20 uploads/day, 1 concurrent download, 100MB file size.
 """
 
+import time
 from datetime import datetime, timedelta
 from db import get_db
 
@@ -11,28 +12,67 @@ MAX_DAILY_UPLOADS = 20
 MAX_CONCURRENT_DOWNLOADS = 1
 MAX_FILE_SIZE_MB = 100
 
+# Download entries older than this are treated as abandoned
+DOWNLOAD_STALE_AFTER = '-1 hour'
+
+def upload_day():
+    """Current UTC day number (matches user_stats.day_bucket)"""
+    return int(time.time() // 86400)
+
+def _hours_until_reset():
+    """Hours until the daily counters reset (midnight UTC)"""
+    now = datetime.utcnow()
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int((tomorrow - now).total_seconds() / 3600)
+
 def check_daily_upload_limit(user_id):
     """
-    Check if user can upload more files today.
+    Check if user can upload more files today (does not consume an upload).
     Returns (can_upload: bool, current_count: int, resets_in_hours: int)
     """
     db = get_db()
     
-    # Count uploads today
     result = db.execute('''
-        SELECT COUNT(*) as count FROM files 
-        WHERE user_id = ? AND DATE(created_at) = DATE('now')
+        SELECT uploads_today, day_bucket FROM user_stats WHERE user_id = ?
     ''', (user_id,)).fetchone()
     
-    current_count = result['count'] if result else 0
+    current_count = result['uploads_today'] if result and result['day_bucket'] == upload_day() else 0
     can_upload = current_count < MAX_DAILY_UPLOADS
     
-    # Calculate hours until reset (midnight UTC)
-    now = datetime.utcnow()
-    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    resets_in_hours = int((tomorrow - now).total_seconds() / 3600)
+    return can_upload, current_count, _hours_until_reset()
+
+def reserve_daily_upload(user_id):
+    """
+    Atomically consume one of today's uploads (compare-and-set in SQL, so
+    concurrent uploads can never overshoot the limit).
+    Returns (reserved: bool, resets_in_hours: int)
+    """
+    db = get_db()
+    today = upload_day()
     
-    return can_upload, current_count, resets_in_hours
+    db.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+    cursor = db.execute('''
+        UPDATE user_stats
+        SET uploads_today = CASE WHEN day_bucket = ? THEN uploads_today + 1 ELSE 1 END,
+            day_bucket = ?
+        WHERE user_id = ? AND (day_bucket <> ? OR uploads_today < ?)
+    ''', (today, today, user_id, today, MAX_DAILY_UPLOADS))
+    db.commit()
+    
+    return cursor.rowcount == 1, _hours_until_reset()
+
+def release_daily_upload(user_id, day, conn=None):
+    """
+    Give back an upload reserved on `day` (see upload_day()) whose upload
+    failed or never started. No-op once the counter has moved to a new day.
+    conn defaults to the request's connection (workers pass their own).
+    """
+    db = conn or get_db()
+    db.execute('''
+        UPDATE user_stats SET uploads_today = uploads_today - 1
+        WHERE user_id = ? AND day_bucket = ? AND uploads_today > 0
+    ''', (user_id, day))
+    db.commit()
 
 def check_file_size_limit(file_size_bytes):
     """
@@ -46,29 +86,30 @@ def get_active_downloads(user_id):
     """
     Get count of active downloads for user.
     Uses rate_limits table to track active downloads.
+    Read-only: entries older than DOWNLOAD_STALE_AFTER are ignored here and
+    deleted by register_download_start.
     """
     db = get_db()
     
-    # Clean up old entries (older than 1 hour are considered stale)
-    db.execute('''
-        DELETE FROM rate_limits 
-        WHERE user_id = ? 
-        AND limit_type = 'download' 
-        AND window_start < datetime('now', '-1 hour')
-    ''', (user_id,))
-    db.commit()
-    
-    # Count active downloads
+    # Count active downloads (range scan on idx_rate_limits_user_window)
     result = db.execute('''
         SELECT COUNT(*) as count FROM rate_limits 
-        WHERE user_id = ? AND limit_type = 'download'
-    ''', (user_id,)).fetchone()
+        WHERE user_id = ? AND limit_type = 'download' AND window_start >= datetime('now', ?)
+    ''', (user_id, DOWNLOAD_STALE_AFTER)).fetchone()
     
     return result['count'] if result else 0
 
 def register_download_start(user_id, file_id):
     """Register that a download has started"""
     db = get_db()
+    
+    # Clean up old entries (downloads that never registered their end)
+    db.execute('''
+        DELETE FROM rate_limits 
+        WHERE user_id = ? 
+        AND limit_type = 'download' 
+        AND window_start < datetime('now', ?)
+    ''', (user_id, DOWNLOAD_STALE_AFTER))
     db.execute('''
         INSERT INTO rate_limits (user_id, limit_type, count, window_start)
         VALUES (?, 'download', ?, CURRENT_TIMESTAMP)
@@ -24,7 +24,7 @@ if __name__ == '__main__':
     print(f"Send Buffer: {send_bytes // 1024}KB")
     print("=" * 60)
     print("PERFORMANCE FEATURES:")
-    print("  ✓ Parallel chunk prefetching (3-4 chunks ahead)")
+    print("  ✓ Parallel chunk prefetching (3 chunks ahead, stalled bodies resumed)")
     print("  ✓ Background hash verification")
     print("  ✓ Direct streaming (no buffering)")
     print("  ✓ IDM compatible headers")
@@ -1,6 +1,77 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import os
-import json
+import orjson
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# deleteMessages accepts at most 100 ids per call
+DELETE_BATCH_SIZE = 100
+DELETE_WORKERS = 8
+
+# One keep-alive session for all Telegram calls, so each call reuses a pooled
+# TLS connection to api.telegram.org instead of opening a new one
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
+_delete_executor = ThreadPoolExecutor(max_workers=DELETE_WORKERS, thread_name_prefix='tg-delete')
+
+# Uploads are paced per bot by a token bucket; a 429 is retried after the
+# retry_after Telegram sends back, up to MAX_RATE_LIMIT_RETRIES times
+SEND_RATE_PER_SECOND = 20
+SEND_BURST = 20
+MAX_RATE_LIMIT_RETRIES = 5
+
+class _TokenBucket:
+    """Allow `burst` calls at once, refilled at `rate` per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+_send_buckets = {}  # bot token -> _TokenBucket
+_send_buckets_lock = threading.Lock()
+
+def _send_bucket(token):
+    with _send_buckets_lock:
+        bucket = _send_buckets.get(token)
+        if bucket is None:
+            bucket = _send_buckets[token] = _TokenBucket(SEND_RATE_PER_SECOND, SEND_BURST)
+        return bucket
+
+def _retry_after(response):
+    """Seconds Telegram asks us to wait on a 429, or None if not rate limited"""
+    if response.status_code != 429:
+        return None
+    try:
+        return response.json()['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+def _rewind_files(files):
+    """Seek upload file objects back to the start before re-sending them"""
+    for value in (files or {}).values():
+        file_handle = value[1] if isinstance(value, tuple) else value
+        if hasattr(file_handle, 'seek'):
+            file_handle.seek(0)
 
 class TelegramClient:
     def __init__(self, token=None, channel_id=None):
@@ -10,14 +81,23 @@ class TelegramClient:
 
     def _request(self, method, endpoint, **kwargs):
         url = f"{self.base_url}/{endpoint}"
+        response = None
         try:
-            response = requests.request(method, url, timeout=30, **kwargs)
+            for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+                response = _session.request(method, url, timeout=30, **kwargs)
+                retry_after = _retry_after(response)
+                if retry_after is None or attempt == MAX_RATE_LIMIT_RETRIES:
+                    break
+                logger.info("Telegram rate limited %s, retrying in %ss", endpoint, retry_after)
+                time.sleep(retry_after)
+                _rewind_files(kwargs.get('files'))
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
-            print(f"Telegram API Error: {e}")
             if response is not None:
-                print(f"Response: {response.text}")
+                logger.warning("Telegram API Error: %s (response: %s)", e, response.text)
+            else:
+                logger.warning("Telegram API Error: %s", e)
             raise
 
     def get_chat(self):
@@ -36,6 +116,7 @@ class TelegramClient:
     def send_document(self, file_handle, filename):
         """
         Uploads a file to the channel.
+        file_handle may be a file object or the content itself (bytes-like).
         Returns the message object.
         """
         files = {
@@ -43,8 +124,9 @@ class TelegramClient:
         }
         data = {
             'chat_id': self.channel_id,
-            'caption': json.dumps({'filename': filename}) # Store metadata in caption just in case
+            'caption': orjson.dumps({'filename': filename}).decode() # Store metadata in caption just in case
         }
+        _send_bucket(self.token).acquire()
         result = self._request('POST', 'sendDocument', data=data, files=files)
         return result['result']
 
@@ -57,6 +139,18 @@ class TelegramClient:
 
     def get_file_download_url(self, file_path):
         return f"https://api.telegram.org/file/bot{self.token}/{file_path}"
+
+    def open_download(self, download_url, timeout, offset=0):
+        """
+        Start a streaming GET for a file URL on the shared keep-alive session.
+        Use as a context manager so the connection goes back to the pool.
+        The body is requested uncompressed so response.raw yields the file bytes;
+        a nonzero offset asks for the rest of the file from there (206).
+        """
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+        return _session.get(download_url, stream=True, timeout=timeout, headers=headers)
         
     def delete_message(self, message_id):
         return self._request('POST', 'deleteMessage', json={
@@ -64,6 +158,41 @@ class TelegramClient:
             'message_id': message_id
         })
 
+    def _delete_message_quietly(self, message_id):
+        try:
+            self.delete_message(message_id)
+        except requests.exceptions.RequestException:
+            pass  # Ignore already missing
+
+    def _delete_batch(self, batch, on_pool=False):
+        try:
+            self._request('POST', 'deleteMessages', json={
+                'chat_id': self.channel_id,
+                'message_ids': batch
+            })
+        except requests.exceptions.RequestException:
+            if on_pool:
+                # Already on a pool worker: waiting on the same pool could deadlock
+                for msg_id in batch:
+                    self._delete_message_quietly(msg_id)
+            else:
+                list(_delete_executor.map(self._delete_message_quietly, batch))
+
+    def delete_messages(self, message_ids):
+        """
+        Delete many messages using deleteMessages, in batches of DELETE_BATCH_SIZE.
+        Falls back to one deleteMessage call per id if a batch is rejected.
+        Batches (and fallback calls) run concurrently on a shared pool.
+        """
+        batches = [list(message_ids[start:start + DELETE_BATCH_SIZE])
+                   for start in range(0, len(message_ids), DELETE_BATCH_SIZE)]
+        if len(batches) == 1:
+            self._delete_batch(batches[0])
+            return
+        for start in range(0, len(batches), DELETE_WORKERS):
+            group = batches[start:start + DELETE_WORKERS]
+            list(_delete_executor.map(self._delete_batch, group, [True] * len(group)))
+
     def get_message(self, message_id):
         """
         Not directly supported by Bot API to get message by ID easily without forwarding.
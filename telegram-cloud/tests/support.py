@@ -0,0 +1,132 @@
+"""
+Shared test setup for TeleCloud.
+Points the database and upload folder at a temporary directory and replaces
+the Telegram Bot API with an in-memory fake, then imports the app once.
+"""
+
+import io
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(SRC_DIR)
+BASELINE_DB = os.path.join(REPO_DIR, 'cloud.db.backup')  # schema v2 database
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+WORK_DIR = tempfile.mkdtemp(prefix='telecloud-tests-')
+os.environ['UPLOAD_FOLDER'] = os.path.join(WORK_DIR, 'uploads')
+
+import db
+db.DB_PATH = os.path.join(WORK_DIR, 'cloud.db')
+
+import telegram_client
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ''
+        self.raw = io.BytesIO(data if isinstance(data, bytes) else b'')
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code), response=self)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeTelegram:
+    """
+    Minimal Bot API: sendDocument stores the body under a new message_id
+    (also used as its file_id and file_path), getFile and file downloads
+    serve it back. Calls are counted per endpoint.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.calls = {}
+        self.fail_tokens = set()  # bot tokens answered with 401
+        self._ids = itertools.count(100)
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        endpoint = url.rsplit('/', 1)[1]
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if '/file/bot' in url:
+            return FakeResponse(self.files[endpoint])
+        token = url.split('/bot', 1)[1].split('/', 1)[0]
+        if token in self.fail_tokens:
+            return FakeResponse({'ok': False, 'description': 'Unauthorized'}, 401)
+        if endpoint == 'sendDocument':
+            content = kwargs['files']['document'][1]
+            if hasattr(content, 'read'):
+                content = content.read()
+            message_id = next(self._ids)
+            self.files[str(message_id)] = bytes(content)
+            return FakeResponse({'ok': True, 'result': {
+                'message_id': message_id, 'document': {'file_id': str(message_id)}}})
+        if endpoint == 'getFile':
+            return FakeResponse({'ok': True, 'result': {'file_path': kwargs['params']['file_id']}})
+        if endpoint in ('getChat', 'deleteMessage', 'deleteMessages'):
+            return FakeResponse({'ok': True, 'result': True})
+        raise AssertionError(f'Unexpected Telegram call: {url}')
+
+
+telegram = FakeTelegram()
+telegram_client._session.request = telegram.request
+telegram_client._session.get = lambda url, **kwargs: telegram.request('GET', url, **kwargs)
+
+from app import app  # noqa: E402  (needs the patches above)
+app.config['TESTING'] = True
+
+_emails = itertools.count()
+
+
+def signup(client, bot_token='123:abc', channel_id='-100', password='secret1'):
+    """Create a user with verified Telegram credentials, logged in on client. Returns (email, user_id)."""
+    email = f'user{next(_emails)}@example.com'
+    response = client.post('/signup', data={
+        'email': email, 'password': password, 'confirm_password': password})
+    assert response.status_code == 302, response.status_code
+    response = client.post('/onboarding/verify', data={'bot_token': bot_token, 'channel_id': channel_id})
+    assert response.get_json() == {'success': True}, response.data
+    with app.app_context():
+        user_id = db.get_db().execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()['id']
+    return email, user_id
+
+
+def upload(client, filename='a.txt', data=b'data'):
+    """POST one file to /upload; returns the response (the upload itself runs in the background)"""
+    return client.post('/upload', data={'file': (io.BytesIO(data), filename)},
+                       content_type='multipart/form-data')
+
+
+def wait_for_upload(client, file_id, timeout=30):
+    """Poll /check_status until the upload leaves 'uploading'; returns the final status JSON"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f'/check_status/{file_id}').get_json()
+        if status['status'] != 'uploading':
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'Upload {file_id} did not finish')
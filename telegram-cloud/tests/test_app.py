@@ -0,0 +1,35 @@
+import unittest
+
+from tests.support import app, signup, upload, wait_for_upload
+
+
+class CheckStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        signup(self.client)
+        self.file_id = upload(self.client).get_json()['file_id']
+        wait_for_upload(self.client, self.file_id)
+
+    def test_matching_etag_gets_an_empty_304(self):
+        first = self.client.get(f'/check_status/{self.file_id}')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json()['status'], 'completed')
+
+        again = self.client.get(f'/check_status/{self.file_id}', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.data, b'')
+        self.assertEqual(again.headers['ETag'], first.headers['ETag'])
+
+    def test_stale_etag_gets_the_current_status(self):
+        response = self.client.get(f'/check_status/{self.file_id}', headers={'If-None-Match': '"uploading:0:1"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['status'], 'completed')
+
+    def test_other_users_file_is_not_found(self):
+        other = app.test_client()
+        signup(other)
+        self.assertEqual(other.get(f'/check_status/{self.file_id}').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
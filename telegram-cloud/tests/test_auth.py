@@ -0,0 +1,147 @@
+import unittest
+from unittest import mock
+
+from tests.support import app, signup, telegram, upload, wait_for_upload
+
+import auth_system
+import db
+
+
+class LoginThrottleTest(unittest.TestCase):
+    def setUp(self):
+        auth_system._login_failures.clear()
+        self.email, _ = signup(app.test_client())
+        self.other_email, _ = signup(app.test_client())
+
+    def login(self, email, password, ip='203.0.113.5'):
+        response = app.test_client().post('/login', data={'email': email, 'password': password},
+                                          environ_base={'REMOTE_ADDR': ip})
+        return response.status_code == 302
+
+    def test_failed_logins_lock_only_that_account_from_that_ip(self):
+        for _ in range(auth_system.MAX_LOGIN_ATTEMPTS):
+            self.assertFalse(self.login(self.email, 'wrong'))
+
+        self.assertFalse(self.login(self.email, 'secret1'))
+        # Same address, other user: unaffected (e.g. everyone behind one proxy/NAT)
+        self.assertTrue(self.login(self.other_email, 'secret1'))
+        # Same user, other address
+        self.assertTrue(self.login(self.email, 'secret1', ip='198.51.100.7'))
+
+    def test_email_is_matched_case_insensitively(self):
+        for _ in range(auth_system.MAX_LOGIN_ATTEMPTS):
+            self.login(self.email.upper(), 'wrong')
+        self.assertFalse(self.login(self.email, 'secret1'))
+
+    def test_per_ip_ceiling_spans_accounts(self):
+        for n in range(auth_system.MAX_LOGIN_ATTEMPTS_PER_IP):
+            self.login(f'nobody{n}@example.com', 'wrong', ip='192.0.2.9')
+
+        self.assertFalse(self.login(self.email, 'secret1', ip='192.0.2.9'))
+        self.assertTrue(self.login(self.email, 'secret1', ip='192.0.2.10'))
+
+    def test_forwarded_for_is_ignored_without_a_trusted_proxy(self):
+        for n in range(auth_system.MAX_LOGIN_ATTEMPTS):
+            app.test_client().post('/login', data={'email': self.email, 'password': 'wrong'},
+                                   environ_base={'REMOTE_ADDR': '203.0.113.5'},
+                                   headers={'X-Forwarded-For': f'198.51.100.{n}'})
+        self.assertFalse(self.login(self.email, 'secret1'))
+
+    def test_success_clears_account_failures(self):
+        for _ in range(auth_system.MAX_LOGIN_ATTEMPTS - 1):
+            self.login(self.email, 'wrong')
+        self.assertTrue(self.login(self.email, 'secret1'))
+        for _ in range(auth_system.MAX_LOGIN_ATTEMPTS - 1):
+            self.login(self.email, 'wrong')
+        self.assertTrue(self.login(self.email, 'secret1'))
+
+
+class SessionCacheTest(unittest.TestCase):
+    """Sessions are cached in process; every way of ending one must reach the cache"""
+
+    def setUp(self):
+        auth_system._login_failures.clear()
+        self.client = app.test_client()
+        self.email, self.user_id = signup(self.client)
+
+    def second_login(self):
+        client = app.test_client()
+        response = client.post('/login', data={'email': self.email, 'password': 'secret1'})
+        self.assertEqual(response.status_code, 302)
+        return client
+
+    def logged_in(self, client):
+        return client.get('/dashboard').status_code == 200
+
+    def test_logged_out_session_is_rejected(self):
+        self.assertTrue(self.logged_in(self.client))  # cached
+        replay = app.test_client()
+        replay.set_cookie('session', self.client.get_cookie('session').value)
+
+        self.client.get('/logout')
+        self.assertFalse(self.logged_in(replay))
+
+    def test_revoked_session_is_rejected(self):
+        other = self.second_login()
+        self.assertTrue(self.logged_in(other))
+        with app.app_context():
+            other_session = db.get_db().execute(
+                'SELECT MAX(id) AS id FROM sessions WHERE user_id = ?', (self.user_id,)).fetchone()['id']
+
+        self.client.post(f'/settings/sessions/{other_session}/revoke')
+        self.assertFalse(self.logged_in(other))
+        self.assertTrue(self.logged_in(self.client))
+
+    def test_revoke_all_rejects_every_session(self):
+        other = self.second_login()
+        self.assertTrue(self.logged_in(other))
+        self.client.post('/settings/sessions/revoke_all')
+        self.assertFalse(self.logged_in(other))
+
+    def test_background_purge_spares_sessions_created_after_revoke_all(self):
+        sessions = [self.second_login() for _ in range(4)]
+        purges = []
+        with mock.patch.object(auth_system, 'SESSION_PURGE_BATCH', 2), \
+                mock.patch.object(auth_system.background, 'submit',
+                                  lambda fn, *args: purges.append((fn, args))):
+            self.client.post('/settings/sessions/revoke_all')
+            fresh = self.second_login()  # logs in again before the purge has run
+            for fn, args in purges:
+                fn(*args)
+
+        self.assertTrue(purges)
+        self.assertTrue(self.logged_in(fresh))
+        self.assertFalse(any(self.logged_in(client) for client in sessions))
+
+    def test_password_change_drops_cached_sessions(self):
+        other = self.second_login()
+        self.assertTrue(self.logged_in(other))
+        self.client.post('/settings/account/password',
+                         data={'current_password': 'secret1', 'new_password': 'secret2'})
+        self.assertFalse(any(entry[0]['id'] == self.user_id for entry in auth_system._session_cache.values()))
+
+        self.assertEqual(app.test_client().post(
+            '/login', data={'email': self.email, 'password': 'secret1'}).status_code, 200)
+        self.assertEqual(app.test_client().post(
+            '/login', data={'email': self.email, 'password': 'secret2'}).status_code, 302)
+
+    def test_rejected_bot_token_is_seen_by_the_next_request(self):
+        client = app.test_client()
+        signup(client, bot_token='555:revoked')
+
+        # Session is now cached with verified credentials
+        self.assertEqual(wait_for_upload(client, upload(client).get_json()['file_id'])['status'], 'completed')
+
+        telegram.fail_tokens.add('555:revoked')
+        try:
+            self.assertEqual(wait_for_upload(client, upload(client).get_json()['file_id'])['status'], 'failed')
+        finally:
+            telegram.fail_tokens.discard('555:revoked')
+
+        # The worker's 401 marked the credentials unverified; the cached session must not hide that
+        response = upload(client)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/settings/telegram', response.location)
+
+if __name__ == '__main__':
+    unittest.main()
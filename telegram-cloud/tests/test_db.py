@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from tests.support import BASELINE_DB, app, signup, upload, wait_for_upload
+
+import db
+from downloader import prepare_download_data
+from utils.packing import chunk_digest, pack_message_ids
+
+
+class RecentFilesCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        signup(self.client)
+
+    def upload_and_wait(self, filename):
+        file_id = upload(self.client, filename).get_json()['file_id']
+        wait_for_upload(self.client, file_id)
+        return file_id
+
+    def dashboard(self):
+        return self.client.get('/dashboard').data
+
+    def test_dashboard_lists_new_uploads_and_drops_deleted_files(self):
+        first = self.upload_and_wait('first.txt')
+        self.assertIn(b'first.txt', self.dashboard())  # list now cached
+
+        self.upload_and_wait('second.txt')
+        page = self.dashboard()
+        self.assertIn(b'first.txt', page)
+        self.assertIn(b'second.txt', page)
+
+        self.assertEqual(self.client.post(f'/files/{first}/delete').status_code, 202)
+        page = self.dashboard()
+        self.assertNotIn(b'first.txt', page)
+        self.assertIn(b'second.txt', page)
+
+
+class BaselineMigrationTest(unittest.TestCase):
+    """The shipped cloud.db.backup is a schema v2 database; it must migrate to SCHEMA_VERSION intact"""
+
+    def setUp(self):
+        work_dir = tempfile.mkdtemp(prefix='telecloud-migrate-')
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        self.path = os.path.join(work_dir, 'cloud.db')
+        shutil.copyfile(BASELINE_DB, self.path)
+
+        with sqlite3.connect(self.path) as conn:
+            self.before = conn.execute('SELECT id, message_ids, chunk_hashes FROM files').fetchall()
+            self.per_user = conn.execute('''
+                SELECT user_id, COUNT(*), SUM(status = 'completed'), SUM(size)
+                FROM files GROUP BY user_id ORDER BY user_id
+            ''').fetchall()
+
+        with mock.patch.object(db, 'DB_PATH', self.path):
+            db.init_db()
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.addCleanup(self.conn.close)
+
+    def test_reaches_current_schema_version(self):
+        self.assertEqual(db.get_schema_version(self.conn), db.SCHEMA_VERSION)
+
+    def test_status_lookup_is_a_rowid_probe_without_extra_indexes(self):
+        indexes = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertNotIn('idx_files_status_cover', indexes)
+        plan = self.conn.execute('EXPLAIN QUERY PLAN SELECT status, uploaded_chunks, chunks FROM files '
+                                 'WHERE user_id = ? AND id = ?', (1, 5)).fetchall()
+        self.assertIn('INTEGER PRIMARY KEY', plan[0]['detail'])
+
+    def test_chunk_lists_are_re_encoded(self):
+        self.assertTrue(self.before)
+        for file_id, message_ids, chunk_hashes in self.before:
+            row = self.conn.execute('SELECT message_ids, chunk_hashes FROM files WHERE id = ?',
+                                    (file_id,)).fetchone()
+            self.assertEqual(row['message_ids'], pack_message_ids(json.loads(message_ids)))
+            self.assertEqual(row['chunk_hashes'], b''.join(bytes.fromhex(h) for h in json.loads(chunk_hashes)))
+
+    def test_migrated_file_is_downloadable(self):
+        file_id, message_ids, chunk_hashes = self.before[0]
+        data = prepare_download_data(file_id, self.conn, '123:abc', '-100')
+        self.assertEqual(list(data['message_ids']), json.loads(message_ids))
+        self.assertEqual(chunk_digest(data['chunk_hashes'], 0).hex(), json.loads(chunk_hashes)[0])
+
+    def test_stats_are_backfilled(self):
+        stats = self.conn.execute('''
+            SELECT user_id, total_files, completed_files, total_bytes FROM user_stats ORDER BY user_id
+        ''').fetchall()
+        self.assertEqual([tuple(row) for row in stats], self.per_user)
+        system = self.conn.execute('SELECT total_files, total_bytes FROM system_stats').fetchone()
+        self.assertEqual(tuple(system), (sum(row[1] for row in self.per_user), sum(row[3] for row in self.per_user)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import urllib3
+
+from tests.support import FakeResponse, telegram
+
+import downloader
+from telegram_client import TelegramClient
+
+
+class ReadHashedBlocksTest(unittest.TestCase):
+    def test_yields_raw_reads_and_hashes_them(self):
+        body = os.urandom(100_000)
+        sha256_hash = hashlib.sha256()
+
+        blocks = list(downloader.read_hashed_blocks(FakeResponse(body), sha256_hash, block_size=32_768))
+
+        self.assertEqual([len(block) for block in blocks], [32_768, 32_768, 32_768, 1_696])
+        self.assertEqual(b''.join(blocks), body)
+        self.assertEqual(sha256_hash.digest(), hashlib.sha256(body).digest())
+
+
+def response_with_rcvbuf(rcvbuf):
+    sock = SimpleNamespace(getsockopt=lambda level, option: rcvbuf)
+    return SimpleNamespace(raw=SimpleNamespace(connection=SimpleNamespace(sock=sock)))
+
+
+class StreamBlockSizeTest(unittest.TestCase):
+    def test_follows_the_receive_buffer_within_bounds(self):
+        self.assertEqual(downloader.stream_block_size(response_with_rcvbuf(1_048_576)), 1_048_576)
+        self.assertEqual(downloader.stream_block_size(response_with_rcvbuf(64 * 1024 * 1024)),
+                         downloader.MAX_BLOCK_SIZE)
+
+    def test_never_goes_below_the_default_block(self):
+        # Linux often reports ~128KB before autotuning grows the buffer
+        self.assertEqual(downloader.stream_block_size(response_with_rcvbuf(131_072)),
+                         downloader.STREAM_BLOCK_SIZE)
+        self.assertEqual(downloader.stream_block_size(FakeResponse(b'')), downloader.STREAM_BLOCK_SIZE)
+
+
+class DownloadStreamTest(unittest.TestCase):
+    BLOCK = 65536
+    BLOCKS_PER_CHUNK = 8
+
+    def setUp(self):
+        self.chunks = [os.urandom(self.BLOCK * self.BLOCKS_PER_CHUNK) for _ in range(6)]
+        self.file_ids = [f'chunk-{id(self)}-{i}' for i in range(len(self.chunks))]
+        for file_id, chunk in zip(self.file_ids, self.chunks):
+            telegram.files[file_id] = chunk
+        self.download_data = {
+            'message_ids': list(range(1, len(self.chunks) + 1)),
+            'chunk_hashes': memoryview(b''.join(hashlib.sha256(chunk).digest() for chunk in self.chunks)),
+            'chunk_file_ids': self.file_ids,
+            'bot_token': '123:abc',
+            'channel_id': '-100',
+        }
+
+        self.lock = threading.Lock()
+        self.open_bodies = 0
+        self.max_open_bodies = 0
+        self.requests = []  # (file_id, offset) per GET
+        self.drop_after = {}  # file_id -> bytes served before the first body for it drops
+        self.honour_range = True
+
+    def open_download(self, url, timeout, offset=0):
+        test = self
+        file_id = url.rsplit('/', 1)[1]
+        with self.lock:
+            self.open_bodies += 1
+            self.max_open_bodies = max(self.max_open_bodies, self.open_bodies)
+            self.requests.append((file_id, offset))
+
+        class Body(FakeResponse):
+            def close(self):
+                with test.lock:
+                    test.open_bodies -= 1
+
+        data = telegram.files[file_id]
+        if offset and self.honour_range:
+            body = Body(data[offset:], 206)
+        else:
+            body = Body(data)
+        drop_after = self.drop_after.pop(file_id, None)
+        if drop_after is not None:
+            read = body.raw.read
+
+            def read_until_dropped(size):
+                if body.raw.tell() >= drop_after:
+                    raise urllib3.exceptions.ReadTimeoutError(None, url, 'Read timed out.')
+                return read(min(size, drop_after - body.raw.tell()))
+            body.raw.read = read_until_dropped
+        return body
+
+    def download(self, delay=0):
+        blocks = []
+        with mock.patch.object(TelegramClient, 'open_download', self.open_download), \
+                mock.patch.object(downloader, 'STREAM_BLOCK_SIZE', self.BLOCK):
+            for block in downloader.create_download_stream(self.download_data):
+                blocks.append(block)
+                time.sleep(delay)
+        return b''.join(blocks)
+
+    def test_slow_client_gets_chunks_downloaded_in_parallel_within_the_cap(self):
+        self.assertEqual(self.download(delay=0.002), b''.join(self.chunks))
+        self.assertGreater(self.max_open_bodies, 1)
+        self.assertLessEqual(self.max_open_bodies, downloader.PREFETCH_CHUNKS + 1)
+        self.assertEqual(self.open_bodies, 0)
+        self.assertEqual(self.requests, [(file_id, 0) for file_id in self.file_ids])
+
+    def test_dropped_body_is_resumed_from_where_it_stopped(self):
+        self.drop_after[self.file_ids[2]] = self.BLOCK * 3
+        self.assertEqual(self.download(), b''.join(self.chunks))
+        self.assertIn((self.file_ids[2], self.BLOCK * 3), self.requests)
+        self.assertEqual(self.open_bodies, 0)
+
+    def test_resume_needs_a_range_response(self):
+        self.drop_after[self.file_ids[2]] = self.BLOCK * 3
+        self.honour_range = False
+        with self.assertRaisesRegex(Exception, 'Chunk 3: Range request not honoured'):
+            self.download()
+
+    def test_corrupt_chunk_fails_the_stream(self):
+        telegram.files[self.file_ids[1]] = os.urandom(len(self.chunks[1]))
+        with self.assertRaisesRegex(Exception, 'Chunk 2: Hash mismatch'):
+            self.download()
+
+
+if __name__ == '__main__':
+    unittest.main()
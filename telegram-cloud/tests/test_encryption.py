@@ -0,0 +1,35 @@
+import unittest
+
+from tests.support import app, signup, telegram, upload, wait_for_upload
+
+import encryption
+
+
+class BotTokenCacheTest(unittest.TestCase):
+    def test_changed_ciphertext_is_not_served_from_cache(self):
+        old, new = encryption.encrypt_bot_token('111:old'), encryption.encrypt_bot_token('222:new')
+        self.assertEqual(encryption.get_bot_token(-1, old), '111:old')
+        self.assertEqual(encryption.get_bot_token(-1, new), '222:new')
+        self.assertEqual(encryption.get_bot_token(-1, new), '222:new')
+
+    def upload_status(self, client):
+        response = upload(client)
+        self.assertEqual(response.status_code, 200, response.data)
+        return wait_for_upload(client, response.get_json()['file_id'])['status']
+
+    def test_updated_bot_token_is_used_by_the_next_upload(self):
+        client = app.test_client()
+        signup(client, bot_token='333:first')
+        self.assertEqual(self.upload_status(client), 'completed')  # old token now cached
+
+        response = client.post('/settings/telegram/update', data={'bot_token': '444:second'})
+        self.assertEqual(response.get_json(), {'success': True})
+        telegram.fail_tokens.add('333:first')
+        try:
+            self.assertEqual(self.upload_status(client), 'completed')
+        finally:
+            telegram.fail_tokens.discard('333:first')
+
+
+if __name__ == '__main__':
+    unittest.main()
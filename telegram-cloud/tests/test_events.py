@@ -0,0 +1,61 @@
+import threading
+import unittest
+from unittest import mock
+
+from tests.support import app, signup, upload, wait_for_upload
+
+import app as app_module
+import progress
+
+
+class EventStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+        _, self.user_id = signup(self.client)
+
+    def read_stream(self, url):
+        """Read the whole event stream on another thread so a stream that never ends fails the test"""
+        result = {}
+        reader = threading.Thread(target=lambda: result.update(body=self.client.get(url).data), daemon=True)
+        reader.start()
+        reader.join(timeout=10)
+        self.assertFalse(reader.is_alive(), 'event stream did not end')
+        return result['body']
+
+    def test_stream_for_a_finished_file_ends_after_its_status(self):
+        file_id = upload(self.client).get_json()['file_id']
+        wait_for_upload(self.client, file_id)
+
+        body = self.read_stream(f'/events?file_id={file_id}')
+        self.assertEqual(body.count(b'data: '), 1)
+        self.assertIn(b'"status":"completed"', body)
+        self.assertNotIn(self.user_id, progress._subscribers)
+
+    def test_stream_ends_when_the_file_fails(self):
+        file_id = 10 ** 6
+        progress.update(file_id, self.user_id, 'uploading', 0, 2)
+        opened = threading.Timer(0.3, progress.update, (file_id + 1, self.user_id, 'uploading', 1, 2))
+        failed = threading.Timer(0.5, progress.finish, (file_id, 'failed'))
+        opened.start()
+        failed.start()
+        try:
+            body = self.read_stream(f'/events?file_id={file_id}')
+        finally:
+            opened.cancel()
+            failed.cancel()
+            progress.finish(file_id + 1, 'completed')
+
+        # Another file's update doesn't end the stream; this file's final status does
+        self.assertIn(f'"file_id":{file_id + 1}'.encode(), body)
+        self.assertTrue(body.endswith(b'"status":"failed","uploaded":0,"total":2}\n\n'), body)
+
+    def test_stream_is_closed_after_its_maximum_lifetime(self):
+        with mock.patch.object(app_module, 'SSE_MAX_STREAM_SECONDS', 0.3), \
+                mock.patch.object(app_module, 'SSE_KEEPALIVE_SECONDS', 0.1):
+            body = self.read_stream('/events')
+        self.assertIn(b': keep-alive', body)
+        self.assertNotIn(self.user_id, progress._subscribers)
+
+
+if __name__ == '__main__':
+    unittest.main()
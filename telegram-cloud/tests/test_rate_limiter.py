@@ -0,0 +1,78 @@
+import io
+import threading
+import time
+import unittest
+
+from tests.support import app, signup, telegram, upload, wait_for_upload
+
+import db
+from rate_limiter import MAX_DAILY_UPLOADS, reserve_daily_upload
+
+
+def uploads_today(user_id):
+    with app.app_context():
+        row = db.get_db().execute('SELECT uploads_today FROM user_stats WHERE user_id = ?',
+                                  (user_id,)).fetchone()
+    return row['uploads_today'] if row else 0
+
+
+def wait_for_uploads_today(user_id, expected, timeout=10):
+    deadline = time.monotonic() + timeout
+    while uploads_today(user_id) != expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return uploads_today(user_id)
+
+
+class DailyUploadReservationTest(unittest.TestCase):
+    def test_concurrent_reservations_never_overshoot(self):
+        _, user_id = signup(app.test_client())
+        results = []
+        start = threading.Barrier(MAX_DAILY_UPLOADS * 2)
+
+        def reserve():
+            with app.app_context():
+                start.wait()
+                results.append(reserve_daily_upload(user_id)[0])
+
+        threads = [threading.Thread(target=reserve) for _ in range(MAX_DAILY_UPLOADS * 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(True), MAX_DAILY_UPLOADS)
+        self.assertEqual(uploads_today(user_id), MAX_DAILY_UPLOADS)
+
+    def test_failed_upload_gives_the_reservation_back(self):
+        client = app.test_client()
+        _, user_id = signup(client, bot_token='401:revoked')
+        telegram.fail_tokens.add('401:revoked')
+        try:
+            response = upload(client)
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertEqual(wait_for_upload(client, response.get_json()['file_id'])['status'], 'failed')
+        finally:
+            telegram.fail_tokens.discard('401:revoked')
+
+        self.assertEqual(wait_for_uploads_today(user_id, 0), 0)
+
+    def test_completed_upload_keeps_the_reservation(self):
+        client = app.test_client()
+        _, user_id = signup(client)
+        response = upload(client)
+        self.assertEqual(wait_for_upload(client, response.get_json()['file_id'])['status'], 'completed')
+        self.assertEqual(uploads_today(user_id), 1)
+
+    def test_aborted_stream_gives_the_reservation_back(self):
+        client = app.test_client()
+        _, user_id = signup(client)
+        # Body ends before Content-Length: the client went away mid-upload
+        response = client.put('/upload/stream', input_stream=io.BytesIO(b'x' * 10),
+                              environ_overrides={'CONTENT_LENGTH': '1000'},
+                              headers={'X-Filename': 'short.bin'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(wait_for_uploads_today(user_id, 0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
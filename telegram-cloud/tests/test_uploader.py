@@ -0,0 +1,84 @@
+import hashlib
+import os
+import unittest
+from unittest import mock
+
+from tests.support import app, signup, telegram, wait_for_upload
+
+import db
+from uploader import ChunkPipe
+from utils import chunker
+
+
+class ChunkPipeTest(unittest.TestCase):
+    def test_yields_chunks_until_finished(self):
+        pipe = ChunkPipe(depth=4)
+        self.assertTrue(pipe.put(b'a'))
+        self.assertTrue(pipe.put(b'b'))
+        pipe.finish()
+        self.assertEqual(list(pipe), [b'a', b'b'])
+
+    def test_abort_raises_in_the_worker(self):
+        pipe = ChunkPipe(depth=4)
+        pipe.put(b'a')
+        pipe.abort(ValueError('client went away'))
+        chunks = iter(pipe)
+        self.assertEqual(next(chunks), b'a')
+        with self.assertRaisesRegex(ValueError, 'client went away'):
+            next(chunks)
+
+    def test_put_fails_once_the_worker_stops(self):
+        pipe = ChunkPipe(depth=1)
+        pipe.put(b'a')
+        pipe.close()
+        self.assertFalse(pipe.put(b'b'))
+
+
+class StreamUploadTest(unittest.TestCase):
+    CHUNK = 65536
+
+    def setUp(self):
+        self.client = app.test_client()
+        signup(self.client)
+        patcher = mock.patch.object(chunker, 'CHUNK_SIZE_BYTES', self.CHUNK)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_streamed_body_is_uploaded_in_chunks_and_downloads_intact(self):
+        payload = os.urandom(self.CHUNK * 3 + 1234)
+        sent_before = telegram.calls.get('sendDocument', 0)
+
+        # The request thread already reads ahead; no second buffering stage
+        with mock.patch('uploader._prepare_chunks') as prepare:
+            response = self.client.put('/upload/stream', data=payload, headers={'X-Filename': 'raw%20data.bin'})
+            self.assertEqual(response.status_code, 200, response.data)
+            file_id = response.get_json()['file_id']
+            self.assertEqual(wait_for_upload(self.client, file_id)['status'], 'completed')
+        prepare.assert_not_called()
+        self.assertEqual(wait_for_upload(self.client, file_id),
+                         {'status': 'completed', 'uploaded': 4, 'total': 4})
+        self.assertEqual(telegram.calls['sendDocument'] - sent_before, 4)
+
+        with app.app_context():
+            row = db.get_db().execute('SELECT filename, size, file_hash FROM files WHERE id = ?',
+                                      (file_id,)).fetchone()
+        self.assertEqual((row['filename'], row['size']), ('raw_data.bin', len(payload)))
+        self.assertEqual(row['file_hash'], hashlib.sha256(payload).hexdigest())
+
+        download = self.client.get(f'/files/{file_id}/download')
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(download.data, payload)
+
+    def test_empty_file_is_accepted(self):
+        response = self.client.put('/upload/stream', environ_overrides={'CONTENT_LENGTH': '0'},
+                                   headers={'X-Filename': 'empty.txt'})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(wait_for_upload(self.client, response.get_json()['file_id'])['status'], 'completed')
+
+    def test_missing_content_length_is_refused(self):
+        response = self.client.put('/upload/stream')
+        self.assertEqual(response.status_code, 411)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,29 +1,129 @@
 import os
-import time
-import json
-import sqlite3
+import logging
+import queue
 import threading
 from utils.chunker import yield_chunks, calculate_total_chunks, get_file_size
-from utils.hasher import calculate_sha256, calculate_file_hash
+from utils.hasher import new_sha256
+from utils.packing import pack_message_ids
 from telegram_client import TelegramClient
-from db import DB_PATH
+import db
+import progress
+from rate_limiter import upload_day, release_daily_upload
+from auth_system import forget_user_sessions
+
+logger = logging.getLogger(__name__)
+
+# || yields TEXT, so the packed lists are cast back to BLOB
+_SQL_APPEND_CHUNK = '''
+    UPDATE files 
+    SET uploaded_chunks = ?,
+        message_ids = CAST(message_ids || ? AS BLOB),
+        chunk_hashes = CAST(chunk_hashes || ? AS BLOB),
+        chunk_file_ids = CAST(json_insert(COALESCE(CAST(chunk_file_ids AS TEXT), '[]'), '$[#]', ?) AS BLOB)
+    WHERE id = ?
+'''
+
+# Streamed uploads: chunks queued between request thread and worker. With the
+# one the request thread is filling and the one being sent, at most 3 chunks
+# (~60MB) of a streamed upload are in memory.
+PIPE_DEPTH = 1
+PIPE_TIMEOUT = 300
+# Uploads from a temp file: chunks read and hashed ahead while the current one
+# is being sent (streamed uploads skip this stage; the request thread already
+# reads ahead)
+PREPARE_DEPTH = 1
+
+class ChunkPipe:
+    """
+    Bounded hand-off of chunks from a request thread to an UploadWorker.
+    put() blocks while PIPE_DEPTH chunks are waiting, so memory per upload
+    stays capped; it returns False once the worker has stopped consuming.
+    """
+    _END = object()
+
+    def __init__(self, depth=PIPE_DEPTH):
+        self._queue = queue.Queue(maxsize=depth)
+        self._closed = threading.Event()
+
+    def put(self, chunk):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(chunk, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def finish(self):
+        """Signal that the last chunk has been put"""
+        self.put(self._END)
+
+    def abort(self, error):
+        """Fail the upload (e.g. the client disconnected mid-body)"""
+        self.put(error)
+
+    def close(self):
+        """Called by the worker when it stops consuming"""
+        self._closed.set()
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=PIPE_TIMEOUT)
+            except queue.Empty:
+                raise Exception("Timed out waiting for upload data")
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+def _hash_chunks(chunks, file_hasher):
+    """Hash chunks inline, yielding (chunk, digest) like the prepared pipe"""
+    for chunk in chunks:
+        file_hasher.update(chunk)
+        yield chunk, new_sha256(chunk).digest()
+
+def _prepare_chunks(chunks, file_hasher, prepared):
+    """
+    First pipeline stage (own thread): read each chunk, hash it, and hand
+    (chunk, digest) to the sending stage through the `prepared` pipe.
+    """
+    source = iter(chunks)
+    try:
+        for chunk in source:
+            file_hasher.update(chunk)
+            if not prepared.put((chunk, new_sha256(chunk).digest())):
+                return  # Sender stopped
+        prepared.finish()
+    except Exception as e:
+        prepared.abort(e)
+    finally:
+        source.close()
 
 class UploadWorker(threading.Thread):
-    def __init__(self, user_id, file_id, temp_path, filename, bot_token, channel_id):
+    def __init__(self, user_id, file_id, temp_path, filename, bot_token, channel_id, pipe=None, size=None):
         threading.Thread.__init__(self)
         self.user_id = user_id
         self.file_id = file_id
         self.temp_path = temp_path
         self.filename = filename
         self.client = TelegramClient(token=bot_token, channel_id=channel_id)
+        # Streamed uploads read chunks from a pipe instead of temp_path
+        self.pipe = pipe
+        self.size = size
+        # Created right after the daily upload was reserved; a failure gives it back
+        self.upload_day = upload_day()
 
 
     def run(self):
-        print(f"[UploadWorker] Starting upload for {self.filename} (ID: {self.file_id})")
+        logger.info("Starting upload for %s (ID: %s)", self.filename, self.file_id)
         
         # New DB connection for thread
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         c = conn.cursor()
+        final_status = 'failed'
+        prepared = None
         
         try:
             # 1. State: Uploading (Already set by caller, but we verify or update)
@@ -31,84 +131,109 @@ class UploadWorker(threading.Thread):
             try:
                 self.client.get_chat()
             except Exception as e:
-                print(f"[UploadWorker] Channel verify failed: {e}")
+                logger.warning("Channel verify failed: %s", e)
                 raise
 
-            # Get total size and chunks
-            size = get_file_size(self.temp_path)
-            total_chunks = calculate_total_chunks(size)
+            if self.pipe is None:
+                # Get total size and chunks
+                size = get_file_size(self.temp_path)
+                # One buffer being read, PREPARE_DEPTH queued, one being sent
+                chunks = yield_chunks(self.temp_path, buffers=PREPARE_DEPTH + 2)
+            else:
+                # Streamed: size is known up front
+                size = self.size
+                chunks = self.pipe
             
-            # Calculate full file hash (optional but good for integrity)
-            full_hash = calculate_file_hash(self.temp_path)
+            # Full file hash is built as chunks are read (single pass over the data)
+            file_hasher = new_sha256()
+            total_chunks = calculate_total_chunks(size)
 
-            c.execute('UPDATE files SET size=?, chunks=?, file_hash=? WHERE id=?', 
-                      (size, total_chunks, full_hash, self.file_id))
+            c.execute('UPDATE files SET size=?, chunks=? WHERE id=?', 
+                      (size, total_chunks, self.file_id))
             conn.commit()
+            progress.update(self.file_id, self.user_id, 'uploading', 0, total_chunks)
 
-            message_ids = []
-            chunk_hashes = []
-            
             chunk_index = 0
             
+            if self.pipe is None:
+                # Read + hash the next chunk on another thread while this one sends
+                prepared = ChunkPipe(depth=PREPARE_DEPTH)
+                threading.Thread(target=_prepare_chunks, args=(chunks, file_hasher, prepared),
+                                 name='upload-prepare', daemon=True).start()
+                hashed = prepared
+            else:
+                # The request thread is already filling the pipe ahead of us
+                hashed = _hash_chunks(chunks, file_hasher)
+            
             # 2. Loop Chunks
-            for chunk_data in yield_chunks(self.temp_path):
+            for chunk_data, chunk_digest in hashed:
                 # Setup chunk filename
                 chunk_index += 1
                 chunk_name = f"{self.filename}.part{chunk_index:04d}"
                 
-                # Compute Hash
-                chunk_hash = calculate_sha256(chunk_data)
-                
-                # Upload
-                # We need a file-like object. memory is fine for 20MB.
-                from io import BytesIO
-                f = BytesIO(chunk_data)
-                f.name = chunk_name # flask/requests might need this
-                
-                msg = self.client.send_document(f, chunk_name)
+                # Upload (requests builds the multipart body straight from the buffer)
+                msg = self.client.send_document(chunk_data, chunk_name)
                 msg_id = msg['message_id']
                 
-                # Update State
-                message_ids.append(msg_id)
-                chunk_hashes.append(chunk_hash)
-                
-                c.execute('''
-                    UPDATE files 
-                    SET uploaded_chunks=?, message_ids=?, chunk_hashes=? 
-                    WHERE id=?
-                ''', (chunk_index, json.dumps(message_ids), json.dumps(chunk_hashes), self.file_id))
+                # Update State: append this chunk's entries (8-byte id, 32-byte
+                # digest, file_id) instead of rewriting the whole lists
+                c.execute(_SQL_APPEND_CHUNK, (
+                    chunk_index, pack_message_ids([msg_id]), chunk_digest,
+                    msg.get('document', {}).get('file_id'), self.file_id
+                ))
                 conn.commit()
+                progress.update(self.file_id, self.user_id, 'uploading', chunk_index, total_chunks)
                 
-                print(f"[UploadWorker] Uploaded chunk {chunk_index}/{total_chunks} for {self.filename}")
-                
-                # Rate Limit
-                time.sleep(1.5)
+                logger.debug("Uploaded chunk %d/%d for %s", chunk_index, total_chunks, self.filename)
 
             # 3. Completion
-            c.execute("UPDATE files SET status='completed' WHERE id=?", (self.file_id,))
+            c.execute("UPDATE files SET file_hash=?, status='completed' WHERE id=?",
+                      (file_hasher.hexdigest(), self.file_id))
             conn.commit()
-            print(f"[UploadWorker] Completed upload for {self.filename}")
+            final_status = 'completed'
+            logger.info("Completed upload for %s", self.filename)
 
         except Exception as e:
-            print(f"[UploadWorker] Failed upload for {self.filename}: {e}")
-            c.execute("UPDATE files SET status='failed' WHERE id=?", (self.file_id,))
+            logger.error("Failed upload for %s: %s", self.filename, e)
             
-            # Detect 401 Unauthorized or similar token issues
+            # Detect 401 Unauthorized or similar token issues. Recorded (and cached
+            # sessions dropped) before the failed status below becomes visible, so
+            # whoever sees 'failed' also sees the unverified credentials.
             if "401" in str(e) or "Unauthorized" in str(e):
-                print(f"[UploadWorker] Detected invalid credentials for user {self.user_id}")
+                logger.warning("Detected invalid credentials for user %s", self.user_id)
                 c.execute("UPDATE users SET credentials_verified = 0 WHERE id = ?", (self.user_id,))
+                conn.commit()
+                forget_user_sessions(self.user_id)
             
+            # A failed upload doesn't count against the daily limit
+            release_daily_upload(self.user_id, self.upload_day, conn)
+            c.execute("UPDATE files SET status='failed' WHERE id=?", (self.file_id,))
             conn.commit()
         finally:
             conn.close()
+            progress.finish(self.file_id, final_status)
+            if prepared is not None:
+                prepared.close()
+            if self.pipe is not None:
+                self.pipe.close()
             # Clean up temp file
-            if os.path.exists(self.temp_path):
+            if self.temp_path and os.path.exists(self.temp_path):
                 try:
                     os.remove(self.temp_path)
                 except Exception as e:
-                    print(f"Error removing temp file: {e}")
+                    logger.warning("Error removing temp file: %s", e)
 
 def start_upload(user_id, file_id, temp_path, filename, bot_token, channel_id):
     worker = UploadWorker(user_id, file_id, temp_path, filename, bot_token, channel_id)
     worker.start()
 
+def start_stream_upload(user_id, file_id, filename, size, bot_token, channel_id):
+    """
+    Start an upload fed chunk by chunk while the request body is still arriving.
+    Returns the ChunkPipe the caller must put() chunks into, then finish().
+    """
+    pipe = ChunkPipe()
+    worker = UploadWorker(user_id, file_id, None, filename, bot_token, channel_id, pipe=pipe, size=size)
+    worker.start()
+    return pipe
+
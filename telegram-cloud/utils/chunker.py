@@ -1,3 +1,4 @@
+import itertools
 import os
 
 # 20MB Strict Limit
@@ -6,17 +7,54 @@ CHUNK_SIZE_BYTES = 20 * 1024 * 1024
 def get_file_size(filepath):
     return os.path.getsize(filepath)
 
-def yield_chunks(filepath):
+def yield_chunks(filepath, buffers=1):
     """
-    Generator that yields chunks of bytes from a file.
-    Ensures memory efficiency by reading only CHUNK_SIZE at a time.
+    Generator that yields chunks of a file as memoryviews.
+    Chunks are read with readinto into a ring of `buffers` reused CHUNK_SIZE
+    buffers, so a chunk stays valid until `buffers` more chunks have been
+    requested; copy it to keep it longer.
     """
-    with open(filepath, 'rb') as f:
-        while True:
-            chunk = f.read(CHUNK_SIZE_BYTES)
-            if not chunk:
+    views = [memoryview(bytearray(CHUNK_SIZE_BYTES)) for _ in range(buffers)]
+    with open(filepath, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for index in itertools.count():
+            view = views[index % buffers]
+            n = _fill(f, view)
+            if not n:
                 break
-            yield chunk
+            yield view[:n]
+
+def _fill(f, view):
+    """readinto until view is full or EOF (raw reads may return short)"""
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+def yield_stream_chunks(stream):
+    """
+    Generator that yields CHUNK_SIZE chunks from a readable stream
+    (e.g. a request body). Short reads are filled up so every chunk but
+    the last is exactly CHUNK_SIZE_BYTES, matching yield_chunks().
+    """
+    while True:
+        parts = []
+        remaining = CHUNK_SIZE_BYTES
+        while remaining:
+            part = stream.read(remaining)
+            if not part:
+                break
+            parts.append(part)
+            remaining -= len(part)
+        if not parts:
+            break
+        yield parts[0] if len(parts) == 1 else b''.join(parts)
+        if remaining:
+            break
 
 def calculate_total_chunks(file_size):
     return (file_size + CHUNK_SIZE_BYTES - 1) // CHUNK_SIZE_BYTES
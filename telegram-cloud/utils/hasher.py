@@ -1,20 +1,10 @@
 import hashlib
+import logging
 
-def calculate_sha256(data):
-    """
-    Calculate SHA-256 hash of a bytes object.
-    """
-    sha256_hash = hashlib.sha256()
-    sha256_hash.update(data)
-    return sha256_hash.hexdigest()
+logger = logging.getLogger(__name__)
 
-def calculate_file_hash(filepath):
-    """
-    Calculate SHA-256 of an entire file efficiently.
-    """
-    sha256_hash = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        # Read in 8k blocks for efficiency
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+# hashlib.sha256 is OpenSSL's (SHA-NI/AVX2 where the CPU has them, GIL released
+# while hashing large buffers) unless Python was built without OpenSSL
+new_sha256 = hashlib.sha256
+if new_sha256.__module__ != '_hashlib':
+    logger.warning("OpenSSL SHA-256 unavailable, using builtin implementation (slower)")
@@ -0,0 +1,24 @@
+"""
+Compact binary encodings for per-file chunk lists stored in SQLite.
+message_ids: big-endian uint64 per chunk; chunk_hashes: raw 32-byte
+SHA-256 digests back to back. Decoding is a single C-level unpack.
+"""
+
+import struct
+
+DIGEST_SIZE = 32
+
+def pack_message_ids(message_ids):
+    return struct.pack(f'>{len(message_ids)}Q', *message_ids)
+
+def unpack_message_ids(blob):
+    if not blob:
+        return ()
+    return struct.unpack(f'>{len(blob) // 8}Q', blob)
+
+def pack_chunk_hashes(hex_digests):
+    return b''.join(bytes.fromhex(h) for h in hex_digests)
+
+def chunk_digest(blob, index):
+    """Raw digest of chunk index from a packed chunk_hashes blob"""
+    return blob[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]